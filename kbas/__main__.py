@@ -18,6 +18,7 @@
 import logging
 import os
 import glob
+import tarfile
 import shutil
 from time import strftime, gmtime
 from datetime import datetime
@@ -26,7 +27,7 @@ import yaml
 from bottle import Bottle, request, response, template, static_file
 from subprocess import call
 
-from ybd import app, cache
+from ybd import app, cache, utils
 
 bottle = Bottle()
 
@@ -99,6 +100,14 @@ class KeyedBinaryArtifactServer(object):
             call(['touch', os.path.dirname(path)])
         return static_file(f, root=app.config['artifact-dir'], download=True)
 
+    @bottle.post('/exists')
+    def exists():
+        '''Return which of the posted list of cache keys we have.'''
+        found = [cache_id for cache_id in request.json or []
+                 if os.path.isdir(os.path.join(app.config['artifact-dir'],
+                                               cache_id))]
+        return {'artifacts': found}
+
     @bottle.get('/')
     @bottle.get('/status')
     def status():
@@ -140,13 +149,16 @@ class KeyedBinaryArtifactServer(object):
         try:
             upload = request.files.get('file')
             artifact = os.path.join(tmpdir, cache_id)
-            upload.save(artifact)
-            if call(['tar', 'tf', artifact]):
-                app.log(this, 'ERROR: not a valid tarfile:', artifact)
-                raise
-            checksum = cache.md5(artifact)
-            with open(artifact + '.md5', "a") as f:
-                f.write(checksum)
+            with open(artifact, 'wb') as f:
+                # check it's a tarfile as we save it, to read it only once
+                f = utils.Checksum(f)
+                stream = utils.GunzipStream(cache.Tee(upload.file, f))
+                with tarfile.open(fileobj=stream, mode='r|') as tar:
+                    for member in tar:
+                        pass
+                while stream.read(1024 * 1024):
+                    pass
+            cache.save_checksum(artifact, f.hexdigest())
             shutil.move(tmpdir, os.path.join(app.config['artifact-dir'],
                                              cache_id))
             response.status = 201  # success!
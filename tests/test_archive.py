@@ -0,0 +1,228 @@
+# Copyright (C) 2016  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# =*= License: GPL-2 =*=
+
+import gzip
+import hashlib
+import os
+import shutil
+import stat
+import tarfile
+import tempfile
+import unittest
+from cStringIO import StringIO
+
+import utils
+
+
+def make_tree(root):
+    '''Fill root with the kinds of things artifacts have in them.'''
+
+    os.makedirs(os.path.join(root, 'usr/bin'))
+    os.makedirs(os.path.join(root, 'usr/lib/empty'))
+    with open(os.path.join(root, 'usr/bin/tool'), 'w') as f:
+        f.write('#!/bin/sh\necho tool\n')
+    os.chmod(os.path.join(root, 'usr/bin/tool'), 0o755)
+    with open(os.path.join(root, 'usr/lib/libbig.so'), 'wb') as f:
+        f.write(os.urandom(1100000))  # big enough to be streamed
+    with open(os.path.join(root, 'usr/lib/empty.txt'), 'w') as f:
+        pass
+    os.link(os.path.join(root, 'usr/bin/tool'),
+            os.path.join(root, 'usr/bin/tool-link'))
+    os.symlink('libbig.so', os.path.join(root, 'usr/lib/libbig.so.1'))
+    os.symlink('/nowhere', os.path.join(root, 'usr/lib/dangling'))
+    os.chmod(os.path.join(root, 'usr/lib/empty'), 0o700)
+    utils.set_mtime_recursively(root)
+
+
+def describe(root):
+    '''Return what extract should preserve about everything under root.'''
+
+    tree = {}
+    inodes = {}
+    for dirname, subdirs, files in os.walk(root):
+        for name in subdirs + files:
+            path = os.path.join(dirname, name)
+            st = os.lstat(path)
+            entry = [stat.S_IFMT(st.st_mode), stat.S_IMODE(st.st_mode)]
+            if stat.S_ISLNK(st.st_mode):
+                entry.append(os.readlink(path))
+            else:
+                entry.append(int(st.st_mtime))
+            if stat.S_ISREG(st.st_mode):
+                with open(path, 'rb') as f:
+                    entry.append(hashlib.md5(f.read()).hexdigest())
+                entry.append(inodes.setdefault(st.st_ino, len(inodes)))
+            tree[os.path.relpath(path, root)] = entry
+    return tree
+
+
+class ChecksumTest(unittest.TestCase):
+
+    def test_passes_data_through(self):
+        output = StringIO()
+        f = utils.Checksum(output)
+        for data in ['some ', 'data ', '', 'in parts']:
+            f.write(data)
+        self.assertEqual(output.getvalue(), 'some data in parts')
+        self.assertEqual(f.tell(), len('some data in parts'))
+        self.assertEqual(f.hexdigest(),
+                         hashlib.md5('some data in parts').hexdigest())
+
+
+class GunzipStreamTest(unittest.TestCase):
+
+    def gzipped(self, data):
+        output = StringIO()
+        with gzip.GzipFile(fileobj=output, mode='wb', mtime=0) as f:
+            f.write(data)
+        return output.getvalue()
+
+    def test_reads_plain_data(self):
+        stream = utils.GunzipStream(StringIO('not gzipped'))
+        self.assertEqual(stream.read(3), 'not')
+        self.assertEqual(stream.read(), ' gzipped')
+
+    def test_reads_all_gzip_members(self):
+        data = self.gzipped('one ') + self.gzipped('') + self.gzipped('two')
+        stream = utils.GunzipStream(StringIO(data))
+        self.assertEqual(stream.read(), 'one two')
+        self.assertEqual(stream.read(), '')
+
+    def test_reads_in_parts(self):
+        data = os.urandom(3000000)
+        stream = utils.GunzipStream(StringIO(self.gzipped(data)))
+        parts = []
+        while True:
+            part = stream.read(100000)
+            if not part:
+                break
+            parts.append(part)
+        self.assertEqual(''.join(parts), data)
+
+
+class ParallelGzipWriterTest(unittest.TestCase):
+
+    def compress(self, data, cpus, writes=1):
+        output = StringIO()
+        with utils.monkeypatch(utils, 'cpu_count', lambda: cpus):
+            f = utils.ParallelGzipWriter(output, 9, 0, block_size=1000)
+            size = len(data) / writes + 1
+            for start in range(0, len(data), size):
+                f.write(data[start:start + size])
+            self.assertEqual(f.tell(), len(data))
+            f.close()
+        return output.getvalue()
+
+    def test_round_trip(self):
+        data = os.urandom(5500)
+        for cpus in [1, 4]:
+            compressed = self.compress(data, cpus, writes=7)
+            self.assertEqual(
+                gzip.GzipFile(fileobj=StringIO(compressed)).read(), data)
+            self.assertEqual(
+                utils.GunzipStream(StringIO(compressed)).read(), data)
+
+    def test_empty(self):
+        compressed = self.compress('', 4)
+        self.assertEqual(
+            gzip.GzipFile(fileobj=StringIO(compressed)).read(), '')
+
+    def test_deterministic(self):
+        data = os.urandom(5500)
+        output = self.compress(data, 1)
+        self.assertEqual(output, self.compress(data, 1, writes=13))
+        self.assertEqual(output, self.compress(data, 4))
+        self.assertEqual(output, self.compress(data, 4, writes=13))
+
+
+class ArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmp, 'root')
+        make_tree(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def archive(self, name, compression='gzip'):
+        base_name = os.path.join(self.tmp, name)
+        md5 = utils.make_deterministic_gztar_archive(
+            base_name, self.root, compression=compression)
+        with open(base_name + '.tar.gz', 'rb') as f:
+            self.assertEqual(md5, hashlib.md5(f.read()).hexdigest())
+        return base_name + '.tar.gz'
+
+    def test_deterministic(self):
+        for compression in utils.codecs:
+            first = self.archive('first', compression)
+            os.utime(self.root, None)  # only the contents should count
+            second = self.archive('second', compression)
+            with open(first, 'rb') as f, open(second, 'rb') as g:
+                self.assertEqual(f.read(), g.read())
+
+    def test_codecs_hold_the_same_tar(self):
+        tars = set()
+        for compression in utils.codecs:
+            with open(self.archive(compression, compression), 'rb') as f:
+                tars.add(utils.GunzipStream(f).read())
+        self.assertEqual(len(tars), 1)
+
+    def test_plain_tar_reads_every_codec(self):
+        # nothing records the codec, so anything reading .tar.gz must cope
+        for compression in utils.codecs:
+            with tarfile.open(self.archive(compression, compression)) as tar:
+                names = [os.path.normpath(name) for name in tar.getnames()]
+            self.assertEqual(sorted(set(names) - {'.'}),
+                             sorted(describe(self.root)))
+
+    def test_extract_round_trip(self):
+        for compression in utils.codecs:
+            destdir = os.path.join(self.tmp, 'extracted-' + compression)
+            os.mkdir(destdir)
+            utils.extract(self.archive(compression, compression), destdir)
+            self.assertEqual(describe(destdir), describe(self.root))
+
+    def test_extract_from_stream(self):
+        with open(self.archive('stream'), 'rb') as f:
+            data = f.read()
+        source = StringIO(data)
+        destdir = os.path.join(self.tmp, 'extracted')
+        os.mkdir(destdir)
+        utils.extract(source, destdir)
+        self.assertEqual(describe(destdir), describe(self.root))
+        self.assertEqual(source.read(), '')  # it all got read
+
+    def test_extract_pooled(self):
+        destdir = os.path.join(self.tmp, 'extracted')
+        os.mkdir(destdir)
+        with utils.monkeypatch(utils, 'cpu_count', lambda: 4):
+            utils.extract(self.archive('pooled'), destdir)
+        self.assertEqual(describe(destdir), describe(self.root))
+
+    def test_extract_refuses_to_escape(self):
+        tarball = os.path.join(self.tmp, 'evil.tar')
+        with tarfile.open(tarball, 'w') as tar:
+            info = tarfile.TarInfo('../evil')
+            tar.addfile(info, StringIO(''))
+        destdir = os.path.join(self.tmp, 'extracted')
+        os.mkdir(destdir)
+        self.assertRaises(IOError, utils.extract, tarball, destdir)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, 'evil')))
+
+
+if __name__ == '__main__':
+    unittest.main()
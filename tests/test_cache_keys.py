@@ -0,0 +1,141 @@
+# Copyright (C) 2016  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# =*= License: GPL-2 =*=
+
+import copy
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import app
+import cache
+import repos
+import utils
+
+
+class Defaults(object):
+    build_steps = ['configure-commands', 'build-commands', 'install-commands']
+    build_systems = {'manual': {'install-commands': []}}
+
+
+class Definitions(object):
+    '''Just enough of definitions.Definitions for cache_key().'''
+
+    def __init__(self, definitions):
+        self.definitions = copy.deepcopy(definitions)
+        self.defaults = Defaults()
+
+    def get(self, this):
+        if isinstance(this, dict):
+            this = this['path']
+        return self.definitions[this]
+
+
+DEFINITIONS = {
+    'a': {'path': 'a', 'name': 'a', 'repo': 'upstream:a', 'ref': 'master',
+          'install-commands': ['make install']},
+    'b': {'path': 'b', 'name': 'b', 'build-depends': ['a'],
+          'install-commands': ['true']},
+    'core': {'path': 'core', 'name': 'core', 'kind': 'stratum',
+             'contents': ['a', 'b']},
+}
+
+
+class CacheKeyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.config = dict(app.config)
+        app.config.update({'arch': 'x86_64', 'base': self.tmp,
+                           'artifacts': self.tmp, 'artifact-version': 1,
+                           'total': 0, 'tasks': 0, 'keys': []})
+        self.trees = {'a': 'tree1'}
+        self.looked_up = []
+        self.patches = [utils.monkeypatch(app, 'log', lambda *args: None),
+                        utils.monkeypatch(repos, 'get_tree', self.get_tree)]
+        for patch in self.patches:
+            patch.__enter__()
+        cache.key_store.clear()
+        cache.artifact_index.clear()
+
+    def tearDown(self):
+        for patch in reversed(self.patches):
+            patch.__exit__(None, None, None)
+        cache.key_store.clear()
+        cache.artifact_index.clear()
+        app.config.clear()
+        app.config.update(self.config)
+        shutil.rmtree(self.tmp)
+
+    def get_tree(self, this):
+        self.looked_up.append(this['path'])
+        return self.trees[this['path']]
+
+    def keys(self, definitions=DEFINITIONS, trees={}):
+        '''Calculate the keys as a fresh run would, and save them.'''
+
+        cache.key_store.clear()
+        defs = Definitions(definitions)
+        for path, tree in trees.items():
+            defs.get(path)['tree'] = tree
+        self.looked_up = []
+        keys = {path: cache.cache_key(defs, path) for path in definitions}
+        cache.save_keys()
+        self.defs = defs
+        return keys
+
+    def test_keys_are_the_hash_of_the_factors(self):
+        keys = self.keys()
+        factors = cache.hash_factors(self.defs, self.defs.get('b'))
+        digest = hashlib.sha256(json.dumps(factors, sort_keys=True))
+        self.assertEqual(keys['b'], 'b.' + digest.hexdigest())
+
+    def test_stored_keys_skip_trees_and_hashing(self):
+        first = self.keys()
+        self.assertEqual(self.looked_up, ['a'])
+        with utils.monkeypatch(cache, 'hash_factors', None):
+            self.assertEqual(self.keys(), first)
+        self.assertEqual(self.looked_up, [])
+        self.assertEqual(self.defs.get('a')['tree'], 'tree1')
+
+    def test_changes_reach_dependents(self):
+        first = self.keys()
+        definitions = copy.deepcopy(DEFINITIONS)
+        definitions['a']['install-commands'] = ['make install-strip']
+        second = self.keys(definitions)
+        for path in ['a', 'b', 'core']:
+            self.assertNotEqual(first[path], second[path])
+
+    def test_moved_ref(self):
+        first = self.keys()
+        self.assertEqual(self.keys(trees={'a': 'tree1'}), first)
+        second = self.keys(trees={'a': 'tree2'})
+        for path in ['a', 'b', 'core']:
+            self.assertNotEqual(first[path], second[path])
+
+    def test_only_used_keys_are_saved(self):
+        self.keys()
+        definitions = copy.deepcopy(DEFINITIONS)
+        definitions['b']['install-commands'] = ['false']
+        self.keys(definitions)
+        with open(os.path.join(self.tmp, 'cache-keys.json')) as f:
+            self.assertEqual(len(json.load(f)), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+# Copyright (C) 2016  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# =*= License: GPL-2 =*=
+
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import time
+import unittest
+
+import requests
+
+import app
+import coordinator
+import utils
+
+
+class Definitions(object):
+    '''Just enough of definitions.Definitions for coordinate() and work().'''
+
+    def __init__(self, paths):
+        self.definitions = {path: {'path': path, 'cache': path + '.key'}
+                            for path in paths}
+
+    def get(self, this):
+        return self.definitions[this]
+
+
+# a needs nothing, b and c need a, d needs b and c
+NODES = {'a': set(), 'b': {'a'}, 'c': {'a'}, 'd': {'b', 'c'}}
+
+
+class CoordinatorTest(unittest.TestCase):
+    '''Run a coordinator and two workers on localhost, with fake builds.'''
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        self.url = 'http://127.0.0.1:%s/' % sock.getsockname()[1]
+        sock.close()
+        self.config = dict(app.config)
+        app.config.update({'coordinator-url': self.url,
+                           'kbas-url': 'http://127.0.0.1:1/',
+                           'kbas-password': 'secret',
+                           'worker-lease-seconds': 2})
+        self.defs = Definitions(NODES)
+        self.patches = [
+            utils.monkeypatch(coordinator, 'log', lambda *args: None),
+            utils.monkeypatch(coordinator, 'graph',
+                              lambda defs, target: dict(NODES)),
+            utils.monkeypatch(coordinator, 'critical_paths',
+                              lambda defs, nodes: {p: 0 for p in nodes}),
+            utils.monkeypatch(coordinator, 'cache_key',
+                              lambda defs, path: defs.get(path)['cache']),
+            utils.monkeypatch(coordinator, 'record_history',
+                              lambda *args: None),
+            utils.monkeypatch(coordinator, 'run', self.fake_build)]
+        for patch in self.patches:
+            patch.__enter__()
+        self.pids = []
+
+    def tearDown(self):
+        for pid in self.pids:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        for patch in reversed(self.patches):
+            patch.__exit__(None, None, None)
+        app.config.clear()
+        app.config.update(self.config)
+        shutil.rmtree(self.tmp)
+
+    def fake_build(self, defs, path):
+        '''Pretend to build path, taking longer than a lease for b.'''
+
+        if path == 'b':
+            time.sleep(3)
+        with open(os.path.join(self.tmp, path), 'a') as f:
+            f.write('%s\n' % os.getppid())
+        os._exit(0)
+
+    def start(self, function):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                function(self.defs, 'target')
+            finally:
+                os._exit(0)
+        self.pids.append(pid)
+        return pid
+
+    def wait(self, pid, timeout=30):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            done, status = os.waitpid(pid, os.WNOHANG)
+            if done:
+                self.pids.remove(pid)
+                return status
+            time.sleep(0.1)
+        self.fail('timed out waiting for %s' % pid)
+
+    def serving(self):
+        for attempt in range(100):
+            try:
+                return requests.get(self.url + 'ping', timeout=5)
+            except requests.exceptions.ConnectionError:
+                time.sleep(0.1)
+        self.fail('coordinator never started')
+
+    def built(self):
+        builders = {}
+        for path in os.listdir(self.tmp):
+            with open(os.path.join(self.tmp, path)) as f:
+                builders[path] = f.read().split()
+        return builders
+
+    def test_two_workers_build_everything(self):
+        coordinator_pid = self.start(coordinator.coordinate)
+        self.assertEqual(self.serving().status_code, 404)
+        workers = [self.start(coordinator.work) for n in range(2)]
+        self.assertEqual(self.wait(coordinator_pid), 0)
+        for pid in workers:
+            self.assertEqual(self.wait(pid), 0)
+        builders = self.built()
+        self.assertEqual(sorted(builders), ['a', 'b', 'c', 'd'])
+        for path in builders:
+            self.assertEqual(len(builders[path]), 1)  # b's lease was renewed
+            self.assertIn(int(builders[path][0]), workers)
+
+    def test_expired_lease_goes_to_another_worker(self):
+        coordinator_pid = self.start(coordinator.coordinate)
+        self.serving()
+        job = requests.get(self.url + 'next', params={'worker': 'dead'},
+                           timeout=5).json()
+        self.assertEqual(job['path'], 'a')
+        workers = [self.start(coordinator.work) for n in range(2)]
+        self.assertEqual(self.wait(coordinator_pid), 0)
+        for pid in workers:
+            self.assertEqual(self.wait(pid), 0)
+        self.assertEqual(sorted(self.built()), ['a', 'b', 'c', 'd'])
+
+
+if __name__ == '__main__':
+    unittest.main()
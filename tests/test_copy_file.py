@@ -0,0 +1,115 @@
+# Copyright (C) 2016  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# =*= License: GPL-2 =*=
+
+import errno
+import os
+import shutil
+import tempfile
+import unittest
+
+import app
+import utils
+
+
+class CopyFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp, 'src')
+        self.data = os.urandom(3 * 1024 * 1024 + 17)
+        with open(self.src, 'wb') as f:
+            f.write(self.data)
+        os.chmod(self.src, 0o751)
+        os.utime(self.src, (1321009871, 1321009871))
+        self.config = dict(app.config)
+        self.calls = []
+
+    def tearDown(self):
+        app.config.clear()
+        app.config.update(self.config)
+        shutil.rmtree(self.tmp)
+
+    def copy(self, name='dest'):
+        dest = os.path.join(self.tmp, name)
+        utils.copy_file(self.src, dest)
+        with open(dest, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+        st = os.stat(dest)
+        self.assertEqual(st.st_mode & 0o7777, 0o751)
+        self.assertEqual(int(st.st_mtime), 1321009871)
+        return dest
+
+    def failing(self, name, error):
+        def copier(infh, outfh):
+            self.calls.append(name)
+            outfh.write('partial copy')
+            raise OSError(error, os.strerror(error))
+        return copier
+
+    def copiers(self, **failures):
+        copiers = dict(utils.copiers)
+        for name, error in failures.items():
+            copiers[name] = self.failing(name, error)
+        return utils.monkeypatch(utils, 'copiers', copiers)
+
+    def test_each_method(self):
+        for method in utils.copy_method_names:
+            app.config['copy-method'] = method
+            try:
+                self.copy(method)
+            except (IOError, OSError) as e:
+                # not every filesystem or kernel can do every method
+                self.assertNotEqual(method, 'userspace')
+                self.assertTrue(e.errno in (errno.EXDEV, errno.EINVAL,
+                                            errno.ENOSYS, errno.EOPNOTSUPP,
+                                            errno.ENOTTY))
+
+    def test_auto(self):
+        app.config['copy-method'] = 'auto'
+        with utils.monkeypatch(utils, 'copy_methods', {}):
+            self.copy()
+
+    def test_falls_back_and_remembers(self):
+        app.config['copy-method'] = 'auto'
+        with utils.monkeypatch(utils, 'copy_methods', {}):
+            with self.copiers(reflink=errno.EOPNOTSUPP,
+                              copy_file_range=errno.EXDEV,
+                              sendfile=errno.ENOSYS):
+                dest = self.copy('first')
+                self.assertEqual(self.calls, ['reflink', 'copy_file_range',
+                                              'sendfile'])
+                dev = os.stat(dest).st_dev
+                self.assertEqual(utils.copy_methods[dev], ['userspace'])
+                self.copy('second')
+                self.assertEqual(len(self.calls), 3)
+
+    def test_other_errors_are_raised(self):
+        app.config['copy-method'] = 'auto'
+        with utils.monkeypatch(utils, 'copy_methods', {}):
+            with self.copiers(reflink=errno.EIO):
+                self.assertRaises(OSError, self.copy)
+                self.assertEqual(utils.copy_methods, {})
+
+    def test_userspace_errors_are_raised(self):
+        app.config['copy-method'] = 'auto'
+        dev = os.stat(self.tmp).st_dev
+        with utils.monkeypatch(utils, 'copy_methods', {dev: ['userspace']}):
+            with self.copiers(userspace=errno.EINVAL):
+                self.assertRaises(OSError, self.copy)
+
+
+if __name__ == '__main__':
+    unittest.main()
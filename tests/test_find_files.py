@@ -0,0 +1,83 @@
+# Copyright (C) 2016  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# =*= License: GPL-2 =*=
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import utils
+
+
+class FindFilesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        for path in ['b.morph', 'a.def', 'notes.txt', 'strata/z.morph',
+                     'strata/core/y.morph', '.git/x.morph']:
+            path = os.path.join(self.root, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(path)
+        os.symlink('strata', os.path.join(self.root, 'linked'))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def find(self):
+        return utils.find_files(self.root, ('.def', '.morph'))
+
+    def test_finds_definitions_in_walk_order(self):
+        paths = [path for path, info in self.find()]
+        expected = []
+        for dirname, subdirs, files in os.walk(self.root):
+            subdirs[:] = sorted(d for d in subdirs if d != '.git')
+            expected += [os.path.relpath(os.path.join(dirname, f), self.root)
+                         for f in sorted(files)
+                         if f.endswith(('.def', '.morph'))]
+        self.assertEqual(paths, expected)
+        self.assertEqual(paths, ['a.def', 'b.morph', 'strata/z.morph',
+                                 'strata/core/y.morph'])
+
+    def test_fingerprint_is_stable(self):
+        self.assertEqual(self.find(), self.find())
+
+    def test_fingerprint_changes_with_content(self):
+        before = dict(self.find())
+        path = os.path.join(self.root, 'strata/z.morph')
+        with open(path, 'a') as f:
+            f.write('more')
+        after = dict(self.find())
+        self.assertNotEqual(before['strata/z.morph'], after['strata/z.morph'])
+        self.assertEqual(before['a.def'], after['a.def'])
+
+    def test_fingerprint_changes_when_replaced(self):
+        before = dict(self.find())
+        path = os.path.join(self.root, 'a.def')
+        os.rename(path, path + '.tmp')
+        shutil.copy2(path + '.tmp', path)
+        os.remove(path + '.tmp')
+        self.assertNotEqual(before['a.def'], dict(self.find())['a.def'])
+
+    def test_same_without_scandir(self):
+        with utils.monkeypatch(utils, 'scandir', None):
+            fallback = self.find()
+        self.assertEqual(fallback, self.find())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+# Copyright (C) 2016  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# =*= License: GPL-2 =*=
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import sandboxlib
+
+import app
+import sandbox
+
+
+@unittest.skipUnless(os.geteuid() == 0, 'sandboxes need root')
+class SessionTest(unittest.TestCase):
+    '''Run commands in a bootstrap-mode session, which uses the host's sh.'''
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.config = dict(app.config)
+        app.config.update({'tmp': self.tmp, 'no-ccache': True,
+                           'sandbox-session': True})
+        self.executor = sandbox.executor
+        sandbox.executor = sandboxlib.executor_for_platform()
+        self.this = {'name': 'test', 'build-mode': 'bootstrap',
+                     'sandbox': self.tmp,
+                     'log': os.path.join(self.tmp, 'test.log')}
+        for directory in ['build', 'install', 'tmp']:
+            self.this[directory] = os.path.join(self.tmp, directory)
+            os.mkdir(self.this[directory])
+        self.env = {'PATH': os.environ['PATH'], 'CCACHE_DIR': '/tmp/ccache'}
+
+    def tearDown(self):
+        sandbox.executor = self.executor
+        app.config.clear()
+        app.config.update(self.config)
+        shutil.rmtree(self.tmp)
+
+    def run_commands(self, *commands):
+        results = []
+        with sandbox.session(self.this, self.env):
+            for command in commands:
+                results.append(self.this['session'](['sh', '-c', command],
+                                                    self.env))
+        return results
+
+    def test_commands_share_a_shell(self):
+        out = os.path.join(self.this['build'], 'out')
+        self.assertEqual(self.run_commands('echo one > %s' % out,
+                                           'echo two >> %s' % out), [0, 0])
+        with open(out) as f:
+            self.assertEqual(f.read(), 'one\ntwo\n')
+
+    def test_env_changes_are_applied(self):
+        out = os.path.join(self.this['build'], 'out')
+        with sandbox.session(self.this, self.env):
+            self.this['session'](['sh', '-c', 'echo "$A" > %s' % out],
+                                 dict(self.env, A='first'))
+            self.this['session'](['sh', '-c', 'echo "${A-unset}" >> %s' % out],
+                                 self.env)
+        with open(out) as f:
+            self.assertEqual(f.read(), 'first\nunset\n')
+
+    def test_stdin_is_not_the_command_fifo(self):
+        out = os.path.join(self.this['build'], 'out')
+        self.assertEqual(self.run_commands('timeout 10 cat > %s' % out,
+                                           'echo next >> %s' % out), [0, 0])
+        with open(out) as f:
+            self.assertEqual(f.read(), 'next\n')
+
+    def test_failure_stops_the_shell(self):
+        results = self.run_commands('exit 3')
+        self.assertEqual(results, [3])
+        self.assertFalse(os.path.exists(
+            os.path.join(self.this['tmp'], 'ybd-commands')))
+
+
+if __name__ == '__main__':
+    unittest.main()
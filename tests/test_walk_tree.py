@@ -0,0 +1,113 @@
+# Copyright (C) 2016  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# =*= License: GPL-2 =*=
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import utils
+
+
+class ThreadPoolTest(unittest.TestCase):
+
+    def test_none_on_one_cpu(self):
+        with utils.monkeypatch(utils, 'cpu_count', lambda: 1):
+            with utils.thread_pool() as pool:
+                self.assertEqual(pool, None)
+
+    def test_threads_are_joined(self):
+        threads = threading.active_count()
+        with utils.monkeypatch(utils, 'cpu_count', lambda: 4):
+            with utils.thread_pool() as pool:
+                self.assertEqual(pool.map(len, ['a', 'bb']), [1, 2])
+                self.assertTrue(threading.active_count() > threads)
+        self.assertEqual(threading.active_count(), threads)
+
+
+class WalkTreeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.expected = set()
+        for directory in ['a', 'a/b', 'a/b/c', 'many', 'empty']:
+            os.mkdir(os.path.join(self.root, directory))
+            self.expected.add(directory)
+        for n in range(600):  # more than one batch
+            self.touch('many/%s' % n)
+        for path in ['top', 'a/one', 'a/b/c/deep']:
+            self.touch(path)
+        os.symlink('a', os.path.join(self.root, 'link'))
+        self.expected.add('link')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def touch(self, path):
+        with open(os.path.join(self.root, path), 'w'):
+            pass
+        self.expected.add(path)
+
+    def walk(self, cpus):
+        visited = []
+        lock = threading.Lock()
+
+        def visit(path, entry):
+            with lock:
+                visited.append((path, entry.is_dir(follow_symlinks=False)))
+
+        with utils.monkeypatch(utils, 'cpu_count', lambda: cpus):
+            count = utils.walk_tree(self.root, visit)
+        self.assertEqual(count, len(visited))
+        return visited
+
+    def check(self, visited):
+        paths = [path for path, is_dir in visited]
+        self.assertEqual(len(paths), len(set(paths)))
+        self.assertEqual(set(paths), self.expected)
+        for path, is_dir in visited:
+            self.assertEqual(is_dir, path in ['a', 'a/b', 'a/b/c', 'many',
+                                              'empty'])
+            # a directory is visited before anything in it
+            parent = os.path.dirname(path)
+            if parent:
+                self.assertTrue(paths.index(parent) < paths.index(path))
+
+    def test_serial(self):
+        self.check(self.walk(1))
+
+    def test_pooled(self):
+        threads = threading.active_count()
+        self.check(self.walk(4))
+        self.assertEqual(threading.active_count(), threads)
+
+    def test_without_scandir(self):
+        with utils.monkeypatch(utils, 'scandir', None):
+            self.check(self.walk(4))
+
+    def test_errors_are_raised(self):
+        def visit(path, entry):
+            if path == 'a/b/c/deep':
+                raise OSError('failed')
+
+        for cpus in [1, 4]:
+            with utils.monkeypatch(utils, 'cpu_count', lambda: cpus):
+                self.assertRaises(OSError, utils.walk_tree, self.root, visit)
+
+
+if __name__ == '__main__':
+    unittest.main()
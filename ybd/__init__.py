@@ -16,10 +16,12 @@
 import app
 import assembly
 import cache
+import coordinator
 import defaults
 import definitions
 import deployment
 import repos
 import sandbox
+import scheduler
 import utils
 import wrangler
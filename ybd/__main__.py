@@ -24,7 +24,10 @@ import app
 from assembly import compose
 from deployment import deploy
 from definitions import Definitions
+from scheduler import plan, schedule
+from coordinator import coordinate, work
 import cache
+import repos
 import sandbox
 import sandboxlib
 
@@ -50,8 +53,10 @@ with app.timer('TOTAL'):
     with app.timer('DEFINITIONS', 'parsing %s' % app.config['def-version']):
         defs = Definitions()
     with app.timer('CACHE-KEYS', 'cache-key calculations'):
+        repos.get_trees(defs, app.config['target'])
         cache.cache_key(defs, app.config['target'])
 
+    cache.flush_last_used()
     cache.cull(app.config['artifacts'])
     target = defs.get(app.config['target'])
     if app.config['total'] == 0 or (app.config['total'] == 1 and
@@ -59,34 +64,48 @@ with app.timer('TOTAL'):
         app.exit('ARCH', 'ERROR: no definitions found for', app.config['arch'])
 
     defs.save_trees()
+    cache.save_keys()
     if app.config.get('mode', 'normal') == 'keys-only':
         with open('./ybd.result', 'w') as f:
             f.write(target['cache'] + '\n')
         os._exit(0)
 
+    if app.config.get('mode', 'normal') == 'plan':
+        plan(defs, target)
+        os._exit(0)
+
     sandbox.executor = sandboxlib.executor_for_platform()
     app.log(app.config['target'], 'Sandbox using %s' % sandbox.executor)
     if sandboxlib.chroot == sandbox.executor:
         app.log(app.config['target'], 'WARNING: using chroot is less safe ' +
                 'than using linux-user-chroot')
 
-    if app.config.get('instances'):
-        app.spawn()
-
-    while True:
-        try:
-            compose(defs, target)
-            break
-        except KeyboardInterrupt:
-            app.log(target, 'Interrupted by user')
-            os._exit(1)
-        except app.RetryException:
-            pass
-        except:
-            import traceback
-            traceback.print_exc()
-            app.log(target, 'Exiting: uncaught exception')
-            os._exit(1)
+    if app.config.get('jobserver'):
+        sandbox.create_jobserver()
+
+    if app.config.get('mode', 'normal') == 'worker':
+        work(defs, target)
+        sandbox.remove_jobserver()
+        os._exit(0)
+
+    try:
+        if app.config.get('mode', 'normal') == 'coordinator':
+            coordinate(defs, target)
+        schedule(defs, target)
+        compose(defs, target)
+        cache.wait_for_archives()
+        cache.flush_last_used()
+        sandbox.remove_jobserver()
+    except KeyboardInterrupt:
+        app.log(target, 'Interrupted by user')
+        sandbox.remove_jobserver()
+        os._exit(1)
+    except:
+        import traceback
+        traceback.print_exc()
+        app.log(target, 'Exiting: uncaught exception')
+        sandbox.remove_jobserver()
+        os._exit(1)
 
     if app.config.get('reproduce'):
         app.log('REPRODUCED',
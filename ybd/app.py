@@ -40,26 +40,6 @@ except ImportError:
 config = {}
 
 
-class RetryException(Exception):
-    def __init__(self, defs, component):
-        if config.get('log-verbose') and \
-                config.get('last-retry-component') != component:
-            log(component, 'Already downloading/building, so wait/retry')
-        if config.get('last-retry-time'):
-            wait = datetime.datetime.now() - config.get('last-retry-time')
-            if wait.seconds < 1:
-                with open(lockfile(defs, component), 'r') as l:
-                    call(['flock', '--shared', '--timeout',
-                          config.get('timeout', '60'), str(l.fileno())])
-                if config['log-verbose']:
-                    log(component, 'Finished wait loop')
-        config['last-retry-time'] = datetime.datetime.now()
-        config['last-retry-component'] = component
-        for dirname in config['sandboxes']:
-            remove_dir(dirname)
-        config['sandboxes'] = []
-
-
 class Counter(object):
     def __init__(self, pid):
         self._counter_file = os.path.join(config['tmp'], str(pid))
@@ -142,7 +122,6 @@ def setup(args):
     log('SETUP', 'Running %s in' % args[0], os.getcwd())
     config['target'] = os.path.basename(os.path.splitext(args[1])[0])
     config['arch'] = args[2]
-    config['sandboxes'] = []
     config['overlaps'] = []
     config['new-overlaps'] = []
 
@@ -165,9 +144,9 @@ def setup(args):
 
     if config.get('kbas-url', 'http://foo.bar/') == 'http://foo.bar/':
         config.pop('kbas-url')
-    if config.get('kbas-url'):
-        if not config['kbas-url'].endswith('/'):
-            config['kbas-url'] += '/'
+    for url in ['kbas-url', 'coordinator-url']:
+        if config.get(url) and not config[url].endswith('/'):
+            config[url] += '/'
 
     config['total'] = config['tasks'] = config['counter'] = 0
     config['reproduced'] = []
@@ -202,6 +181,10 @@ def setup(args):
     if not config.get('max-jobs'):
         config['max-jobs'] = cpu_count() / config.get('instances', 1)
 
+    if config.get('max-downloads', 4) < 1:
+        exit('SETUP', 'ERROR: max-downloads must be at least 1, not',
+             config['max-downloads'])
+
     config['pid'] = os.getpid()
     config['counter'] = Counter(config['pid'])
     log('SETUP', '%s version is' % config['program'], config['my-version'])
@@ -231,8 +214,18 @@ def cleanup(tmpdir):
             to_delete = os.listdir(tmpdir)
             fcntl.flock(tmp_lock, fcntl.LOCK_SH | fcntl.LOCK_NB)
             if os.fork() == 0:
+                # a failed build can leave its overlay and tmpfs mounted.
+                # reverse order unmounts the tmpfs ones inside first
+                with open('/proc/mounts') as f:
+                    mounts = [line.split()[1] for line in f]
+                for mount in sorted(mounts, reverse=True):
+                    top = os.path.relpath(mount, tmpdir).split(os.sep)[0]
+                    if top in to_delete:
+                        call(['umount', '-l', mount])
                 for dirname in to_delete:
                     remove_dir(os.path.join(tmpdir, dirname))
+                    if dirname.startswith('jobserver.'):
+                        os.remove(os.path.join(tmpdir, dirname))  # a FIFO
                 log('SETUP', 'Cleanup successful for', tmpdir)
                 sys.exit(0)
     except IOError:
@@ -292,11 +285,3 @@ def elapsed(starttime):
     hours, remainder = divmod(int(td.total_seconds()), 60*60)
     minutes, seconds = divmod(remainder, 60)
     return "%02d:%02d:%02d" % (hours, minutes, seconds)
-
-
-def spawn():
-    for fork in range(1, config.get('instances')):
-        if os.fork() == 0:
-            config['fork'] = fork
-            log('FORKS', 'I am fork', config.get('fork'))
-            break
@@ -15,7 +15,6 @@
 # =*= License: GPL-2 =*=
 
 import os
-import random
 from subprocess import call, check_output
 import contextlib
 import fcntl
@@ -23,14 +22,15 @@ import errno
 
 import json
 from app import config, chdir, exit, timer, elapsed
-from app import log, log_riemann, lockfile, RetryException
-from cache import cache, cache_key, get_cache, get_remote
+from app import log, log_riemann, lockfile
+from cache import cache, cache_key, get_cache, get_remote, record_history
 import repos
 import sandbox
 from shutil import copyfile
 import time
 import datetime
 import splitting
+import utils
 
 
 def compose(defs, target):
@@ -52,6 +52,8 @@ def compose(defs, target):
     # if we have a kbas, look there to see if this component exists
     if config.get('kbas-url') and not config.get('reproduce'):
         with claim(defs, component):
+            if get_cache(defs, component):
+                return cache_key(defs, component)
             if get_remote(defs, component):
                 config['counter'].increment()
                 return cache_key(defs, component)
@@ -68,9 +70,7 @@ def compose(defs, target):
 
 def assemble(defs, component):
     '''Handle creation of composite components (strata, systems, clusters)'''
-    systems = component.get('systems', [])
-    shuffle(systems)
-    for system in systems:
+    for system in component.get('systems', []):
         compose(defs, system['path'])
         for subsystem in system.get('subsystems', []):
             compose(defs, subsystem)
@@ -85,10 +85,18 @@ def build(defs, component):
         return
 
     with claim(defs, component):
+        if get_cache(defs, component):
+            return
         if component.get('kind', 'chunk') == 'chunk':
             install_dependencies(defs, component)
+            sandbox.stage(component)
         with timer(component, 'build of %s' % component['cache']):
-            run_build(defs, component)
+            try:
+                run_build(defs, component)
+            except sandbox.TmpfsFull:
+                sandbox.unmount_tmpfs(component)
+                log(component, 'Building again on disk')
+                run_build(defs, component)
 
         with timer(component, 'artifact creation'):
             splitting.write_metadata(defs, component)
@@ -116,15 +124,16 @@ def run_build(defs, this):
     env_vars = sandbox.env_vars_for_build(defs, this)
 
     log(this, 'Logging build commands to %s' % this['log'])
-    for build_step in defs.defaults.build_steps:
-        if this.get(build_step):
-            log(this, 'Running', build_step)
-        for command in this.get(build_step, []):
-            command = 'false' if command is False else command
-            command = 'true' if command is True else command
-            sandbox.run_sandboxed(
-                this, command, env=env_vars,
-                allow_parallel=('build' in build_step))
+    with sandbox.session(this, env_vars):
+        for build_step in defs.defaults.build_steps:
+            if this.get(build_step):
+                log(this, 'Running', build_step)
+            for command in this.get(build_step, []):
+                command = 'false' if command is False else command
+                command = 'true' if command is True else command
+                sandbox.run_sandboxed(
+                    this, command, env=env_vars,
+                    allow_parallel=('build' in build_step))
 
     if this.get('devices'):
         sandbox.create_devices(this)
@@ -133,72 +142,67 @@ def run_build(defs, this):
         time_elapsed = elapsed(this['start-time'])
         logfile.write('Elapsed_time: %s\n' % time_elapsed)
         log_riemann(this, 'Artifact_Timer', this['name'], time_elapsed)
-
-
-def shuffle(contents):
-    if config.get('instances', 1) > 1:
-        random.seed(datetime.datetime.now())
-        random.shuffle(contents)
+    record_history(this, 'duration', int(
+        (datetime.datetime.now() - this['start-time']).total_seconds()))
+    if config.get('tmpfs-megabytes') and this.get('kind', 'chunk') == 'chunk':
+        # so that next time, sandbox.mount_tmpfs() knows how much it needs
+        for directory in ['build', 'install']:
+            megabytes = utils.disk_usage(this[directory]) / 1024 / 1024 + 1
+            record_history(this, directory + '-megabytes', megabytes)
 
 
 @contextlib.contextmanager
 def claim(defs, this):
-    with open(lockfile(defs, this), 'a') as l:
-        try:
-            fcntl.flock(l, fcntl.LOCK_EX | fcntl.LOCK_NB)
-        except Exception as e:
-            if e.errno in (errno.EACCES, errno.EAGAIN):
-                # flock() will report EACCESS or EAGAIN when the lock fails.
-                raise RetryException(defs, this)
-            else:
-                import traceback
-                traceback.print_exc()
-                exit(this, 'ERROR: a surprise exception happened', '')
-        try:
-            yield
-        finally:
-            if os.path.isfile(lockfile(defs, this)):
-                os.remove(lockfile(defs, this))
+    '''Lock this while we work on it, waiting if someone else already is.
 
+    If another ybd holds the lock we block on it until they are finished, so
+    the caller should check again whether this is cached before working.
 
-def install_contents(defs, component):
-    '''Install recursed contents of component into component's sandbox.'''
-
-    def install(defs, component, contents):
-        shuffle(contents)
-        for it in contents:
-            content = defs.get(it)
-            if os.path.exists(os.path.join(component['sandbox'], 'baserock',
-                                           content['name'] + '.meta')):
-                # content has already been installed
-                if config.get('log-verbose'):
-                    log(component, 'Already installed', content['name'])
+    '''
+    while True:
+        with open(lockfile(defs, this), 'a') as l:
+            try:
+                fcntl.flock(l, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except Exception as e:
+                if e.errno not in (errno.EACCES, errno.EAGAIN):
+                    import traceback
+                    traceback.print_exc()
+                    exit(this, 'ERROR: a surprise exception happened', '')
+                # flock() will report EACCESS or EAGAIN when the lock fails.
+                log(this, 'Waiting for another instance to finish',
+                    this['cache'])
+                fcntl.flock(l, fcntl.LOCK_SH)
                 continue
+            try:
+                yield
+            finally:
+                if os.path.isfile(lockfile(defs, this)):
+                    os.remove(lockfile(defs, this))
+            return
 
-            if component.get('kind', 'chunk') == 'system':
-                artifacts = None
-
-                for stratum in component['strata']:
-                    if stratum['path'] == content['path']:
-                        artifacts = stratum.get('artifacts')
-                        break
 
-                if artifacts:
-                    compose(defs, content)
-                    splitting.install_stratum_artifacts(defs, component,
-                                                        content, artifacts)
-                    continue
-
-            install(defs, component, content.get('contents', []))
-            compose(defs, content)
-            if content.get('build-mode', 'staging') != 'bootstrap':
-                sandbox.install(defs, component, content)
+def install_contents(defs, component):
+    '''Install recursed contents of component into component's sandbox.'''
 
     component = defs.get(component)
     contents = component.get('contents', [])
     if config.get('log-verbose'):
         log(component, 'Installing contents\n', contents)
-    install(defs, component, contents)
+    artifacts = {stratum['path']: stratum.get('artifacts')
+                 for stratum in component.get('strata', [])}
+
+    # a system's integration commands can change any file in its sandbox,
+    # and hardlinked files would be changed in the cache too
+    copy = component.get('kind') == 'system' and \
+        gather_integration_commands(defs, component) != []
+    for action, path in staging_list(defs, component, 'contents'):
+        compose(defs, path)
+        if action == 'split':
+            splitting.install_stratum_artifacts(defs, component,
+                                                defs.get(path),
+                                                artifacts[path])
+        elif action == 'install':
+            sandbox.install(defs, component, defs.get(path), copy)
     if config.get('log-verbose'):
         sandbox.list_files(component)
 
@@ -206,33 +210,74 @@ def install_contents(defs, component):
 def install_dependencies(defs, component):
     '''Install recursed dependencies of component into component's sandbox.'''
 
-    def install(defs, component, dependencies):
-        shuffle(dependencies)
+    component = defs.get(component)
+    dependencies = component.get('build-depends', [])
+    if config.get('log-verbose'):
+        log(component, 'Installing dependencies\n', dependencies)
+    for action, path in staging_list(defs, component, 'build-depends'):
+        if action == 'compose':
+            compose(defs, path)
+        else:
+            sandbox.install(defs, component, defs.get(path))
+    if config.get('log-verbose'):
+        sandbox.list_files(component)
+
+
+def staging_list(defs, component, field):
+    '''Return the steps to stage component's build-depends or contents.
+
+    Each step is an (action, path) pair, in the order the recursive walk of
+    the definitions would take them. Anything already installed in the walk
+    is skipped, so each component is only visited once however many others
+    depend on it.
+
+    '''
+    steps = []
+    installed = set()
+    artifacts = {}
+    if component.get('kind', 'chunk') == 'system':
+        artifacts = {stratum['path']: stratum.get('artifacts')
+                     for stratum in component['strata']}
+
+    def install_contents(contents):
+        for it in contents:
+            content = defs.get(it)
+            if content['name'] in installed:
+                continue
+
+            if artifacts.get(content['path']):
+                steps.append(('split', content['path']))
+                installed.add(content['name'])
+                continue
+
+            install_contents(content.get('contents', []))
+            if content.get('build-mode', 'staging') == 'bootstrap':
+                steps.append(('compose', content['path']))
+            else:
+                steps.append(('install', content['path']))
+                installed.add(content['name'])
+
+    def install_dependencies(dependencies):
         for it in dependencies:
             dependency = defs.get(it)
-            if os.path.exists(os.path.join(component['sandbox'], 'baserock',
-                                           dependency['name'] + '.meta')):
-                # dependency has already been installed
-                if config.get('log-verbose'):
-                    log(component, 'Already installed', dependency['name'])
+            if dependency['name'] in installed:
                 continue
 
-            install(defs, component, dependency.get('build-depends', []))
+            install_dependencies(dependency.get('build-depends', []))
             if (it in component['build-depends']) or \
                 (dependency.get('build-mode', 'staging') ==
                     component.get('build-mode', 'staging')):
-                compose(defs, dependency)
+                steps.append(('compose', it))
                 if dependency.get('contents'):
-                    install(defs, component, dependency.get('contents'))
-                sandbox.install(defs, component, dependency)
+                    install_dependencies(dependency.get('contents'))
+                steps.append(('install', it))
+                installed.add(dependency['name'])
 
-    component = defs.get(component)
-    dependencies = component.get('build-depends', [])
-    if config.get('log-verbose'):
-        log(component, 'Installing dependencies\n', dependencies)
-    install(defs, component, dependencies)
-    if config.get('log-verbose'):
-        sandbox.list_files(component)
+    if field == 'contents':
+        install_contents(component.get('contents', []))
+    else:
+        install_dependencies(component.get('build-depends', []))
+    return steps
 
 
 def get_build_commands(defs, this):
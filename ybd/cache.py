@@ -16,12 +16,17 @@
 
 import requests
 
+import errno
+import fcntl
 import hashlib
 import json
+import marshal
 import os
 import shutil
+import stat
+from subprocess import check_call
 import sys
-from subprocess import call
+import time
 
 import app
 import repos
@@ -30,6 +35,10 @@ import tempfile
 import yaml
 
 cache_list = {}
+key_store = {}
+artifact_index = {}
+last_used = set()
+archivers = {}
 
 
 def cache_key(defs, this):
@@ -48,12 +57,7 @@ def cache_key(defs, this):
 
     definition['cache'] = 'calculating'
 
-    if definition.get('repo') and not definition.get('tree'):
-        definition['tree'] = repos.get_tree(definition)
-
-    factors = hash_factors(defs, definition)
-    factors = json.dumps(factors, sort_keys=True).encode('utf-8')
-    key = hashlib.sha256(factors).hexdigest()
+    key = get_key(defs, definition)
     if app.config.get('mode', 'normal') == 'no-build':
         key = 'no-build'
 
@@ -78,22 +82,19 @@ def cache_key(defs, this):
     return definition['cache']
 
 
-def hash_factors(defs, definition):
-    hash_factors = {'arch': app.config['arch']}
+def dependency_keys(defs, definition):
+    ''' Return the cache keys of everything definition's key depends on. '''
 
+    keys = {}
     for factor in definition.get('build-depends', []):
-        hash_factors[factor] = cache_key(defs, factor)
+        keys[factor] = cache_key(defs, factor)
 
     for factor in definition.get('contents', []):
-        hash_factors[factor] = cache_key(defs, factor)
-
-    for factor in ['tree', 'submodules'] + defs.defaults.build_steps:
-        if definition.get(factor):
-            hash_factors[factor] = definition[factor]
+        keys[factor] = cache_key(defs, factor)
 
     def hash_system_recursively(system):
         factor = system.get('path', 'BROKEN')
-        hash_factors[factor] = cache_key(defs, factor)
+        keys[factor] = cache_key(defs, factor)
         for subsystem in system.get('subsystems', []):
             hash_system_recursively(subsystem)
 
@@ -101,6 +102,17 @@ def hash_factors(defs, definition):
         for system in definition.get('systems', []):
             hash_system_recursively(system)
 
+    return keys
+
+
+def hash_factors(defs, definition):
+    hash_factors = {'arch': app.config['arch']}
+    hash_factors.update(dependency_keys(defs, definition))
+
+    for factor in ['tree', 'submodules'] + defs.defaults.build_steps:
+        if definition.get(factor):
+            hash_factors[factor] = definition[factor]
+
     if app.config.get('artifact-version', False):
         hash_factors['artifact-version'] = app.config.get('artifact-version')
         hash_factors['default-build-systems'] = defs.defaults.build_systems
@@ -108,6 +120,81 @@ def hash_factors(defs, definition):
     return hash_factors
 
 
+def get_key(defs, definition):
+    ''' Return the hash of definition's factors, or the one from last time.
+
+    Keys are stored with the tree they were made from, against a digest of
+    the definition as loaded, the keys of its dependencies and the settings
+    which go into every key. So for a definition which hasn't changed we
+    skip resolving its tree and hashing its factors. A tree resolved this
+    run which doesn't match the stored one means the ref has moved. The
+    digests we use are noted, so only those are saved for next time.
+
+    '''
+    if not key_store:
+        key_store.update(load_keys())
+
+    build_systems = defs.defaults.build_systems
+    if key_store.get('build-systems', [None])[0] is not build_systems:
+        key_store['build-systems'] = [build_systems, digest(build_systems)]
+    inputs = digest({
+        'definition': {k: v for k, v in definition.items()
+                       if k not in ['cache', 'tree']},
+        'dependencies': dependency_keys(defs, definition),
+        'arch': app.config['arch'],
+        'artifact-version': app.config.get('artifact-version', False),
+        'build-systems': key_store['build-systems'][1]})
+
+    key_store.setdefault('used', set()).add(inputs)
+    stored = key_store['keys'].get(inputs)
+    if stored and definition.get('tree', stored[1]) == stored[1]:
+        if stored[1]:
+            definition['tree'] = stored[1]
+        return stored[0]
+
+    if definition.get('repo') and not definition.get('tree'):
+        definition['tree'] = repos.get_tree(definition)
+    factors = json.dumps(hash_factors(defs, definition), sort_keys=True)
+    key = hashlib.sha256(factors.encode('utf-8')).hexdigest()
+    key_store['keys'][inputs] = [key, definition.get('tree')]
+    key_store['changed'] = True
+    return key
+
+
+def digest(factors):
+    return hashlib.sha1(json.dumps(factors, sort_keys=True)).hexdigest()
+
+
+def load_keys():
+    ''' Return the keys stored from previous runs, if any. '''
+
+    try:
+        with open(os.path.join(app.config['base'], 'cache-keys.json')) as f:
+            return {'keys': {inputs: stored for inputs, stored
+                             in json.load(f).items()
+                             if isinstance(stored, list)}}
+    except:
+        return {'keys': {}}
+
+
+def save_keys():
+    ''' Store the keys used for this target, for next time.
+
+    Keys for definitions which have since changed, or for other targets, are
+    dropped, so the store doesn't grow with every edit to definitions.
+
+    '''
+    used = key_store.get('used', set())
+    if not key_store.get('changed') and used == set(key_store['keys']):
+        return
+    keys = dict((inputs, key_store['keys'][inputs]) for inputs in used)
+    with open(os.path.join(app.config['base'], 'cache-keys.json'), 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.truncate(0)
+        json.dump(keys, f, indent=0, sort_keys=True, separators=(',', ': '))
+    key_store['changed'] = False
+
+
 def cache(defs, this):
     if get_cache(defs, this):
         app.log(this, "Bah! I could have cached", cache_key(defs, this))
@@ -120,41 +207,135 @@ def cache(defs, this):
         shutil.rmtree(this['install'])
         shutil.rmtree(this['build'])
         utils.set_mtime_recursively(this['sandbox'])
-        utils.make_deterministic_tar_archive(cachefile, this['sandbox'])
+        checksum = utils.make_deterministic_tar_archive(cachefile,
+                                                        this['sandbox'])
         shutil.move('%s.tar' % cachefile, cachefile)
+        save_checksum(cachefile, checksum)
     else:
+        # the install dir is what we'd get by unpacking the artifact, so
+        # use it as is. the tarball can be made from it afterwards
         utils.set_mtime_recursively(this['install'])
-        utils.make_deterministic_gztar_archive(cachefile, this['install'])
-        shutil.move('%s.tar.gz' % cachefile, cachefile)
+        if this.get('tmpfs'):
+            # a mount point can't be moved, so copy it off the tmpfs
+            check_call(['cp', '-a', this['install'], cachefile + '.unpacked'])
+        else:
+            shutil.move(this['install'], cachefile + '.unpacked')
 
     app.config['counter'].increment()
-    unpack(defs, this, cachefile)
+    if not unpack(defs, this, cachefile) or this.get('kind') == 'system':
+        return
+
+    push = app.config.get('kbas-password', 'insecure') != 'insecure' and \
+        app.config.get('kbas-url') is not None
+    if not push and not app.config.get('serve-artifacts'):
+        return
+
+    # nothing else here needs the tarball, so a chunk's can be made while
+    # we get on with the next build. but a worker must have uploaded before
+    # it reports back, and reproduce needs to know the results
+    if this.get('kind', 'chunk') == 'chunk' and \
+            not app.config.get('reproduce') and \
+            app.config.get('mode') != 'worker':
+        wait_for_archives()  # one at a time, since each uses every core
+        pid = os.fork()
+        if pid:
+            archivers[pid] = this
+            return
+        # don't hold the build's locks (claim, snapshot, layers) while we work
+        os.closerange(3, os.sysconf('SC_OPEN_MAX'))
+        try:
+            archive(defs, this, push)
+        except:
+            import traceback
+            traceback.print_exc()
+            os._exit(1)
+        os._exit(0)
+    archive(defs, this, push)
 
-    if app.config.get('kbas-password', 'insecure') != 'insecure' and \
-            app.config.get('kbas-url') is not None:
-        if this.get('kind', 'chunk') in ['chunk', 'stratum']:
-            with app.timer(this, 'upload'):
-                upload(defs, this)
+
+def wait_for_archives():
+    ''' Wait for the tarballs being made by cache(), exiting if any failed.
+
+    Until then get_cache() can return the path of a tarball which isn't
+    there yet, so this must be called before anything needs one, and before
+    the build finishes.
+
+    '''
+    for pid in sorted(archivers):
+        archive_done(pid, os.waitpid(pid, 0)[1])
+
+
+def archive_done(pid, status):
+    ''' Check the exit status of an archiving child someone else reaped. '''
+
+    this = archivers.pop(pid, None)
+    if this and status != 0:
+        app.exit(this, 'ERROR: failed to archive or upload', this['cache'])
+
+
+def archive(defs, this, push):
+    ''' Make the tarball for a cached artifact from its .unpacked dir. '''
+
+    artifact = get_cache(defs, this)
+    compression = get_compression(this)
+    checksum = utils.make_deterministic_gztar_archive(
+        artifact + '.partial', artifact + '.unpacked',
+        compression=compression)
+    save_checksum(artifact, checksum)
+    os.rename(artifact + '.partial.tar.gz', artifact)
+    app.log(this, 'Cached %s bytes %s as' % (os.path.getsize(artifact),
+                                             checksum),
+            cache_key(defs, this))
+
+    if push and this.get('kind', 'chunk') in ['chunk', 'stratum']:
+        with app.timer(this, 'upload'):
+            if not upload(defs, this) and app.config.get('mode') == 'worker':
+                # the coordinator must not think other workers can get it
+                app.exit(this, 'ERROR: failed to upload', this['cache'])
+
+
+def get_compression(this):
+    ''' Return the codec for this artifact, from utils.codecs.
+
+    Only chunks are worth compressing differently. Everything else, and
+    everything when reproducing, uses plain gzip so it can be compared
+    bit-for-bit with artifacts from elsewhere.
+
+    '''
+    if this.get('kind', 'chunk') != 'chunk' or app.config.get('reproduce'):
+        return 'gzip'
+
+    compression = app.config.get('compression', 'gzip')
+    if compression not in utils.codecs:
+        app.exit(this, 'ERROR: unknown compression', compression)
+    return compression
 
 
 def unpack(defs, this, tmpfile):
     unpackdir = tmpfile + '.unpacked'
-    os.makedirs(unpackdir)
-    if call(['tar', 'xf', tmpfile, '--directory', unpackdir]):
-        app.log(this, 'Problem unpacking', tmpfile)
-        shutil.rmtree(os.path.dirname(tmpfile))
-        return False
+    if not os.path.isdir(unpackdir):
+        os.makedirs(unpackdir)
+        try:
+            utils.extract(tmpfile, unpackdir)
+        except:
+            app.log(this, 'Problem unpacking', tmpfile)
+            shutil.rmtree(os.path.dirname(tmpfile))
+            return False
+    deduplicate(tmpfile)
+    index_metadata(defs, this, tmpfile)
 
     try:
         path = os.path.join(app.config['artifacts'], cache_key(defs, this))
         shutil.move(os.path.dirname(tmpfile), path)
         if not os.path.isdir(path):
             app.exit(this, 'ERROR: problem creating cache artifact', path)
+        artifact_index[cache_key(defs, this)] = True
 
-        size = os.path.getsize(get_cache(defs, this))
-        checksum = md5(get_cache(defs, this))
-        app.log(this, 'Cached %s bytes %s as' % (size, checksum),
-                cache_key(defs, this))
+        if os.path.exists(get_cache(defs, this)):
+            size = os.path.getsize(get_cache(defs, this))
+            checksum = get_checksum(get_cache(defs, this))
+            app.log(this, 'Cached %s bytes %s as' % (size, checksum),
+                    cache_key(defs, this))
         return path
     except:
         app.log(this, 'Bah! I raced on', cache_key(defs, this))
@@ -162,24 +343,99 @@ def unpack(defs, this, tmpfile):
         return False
 
 
+def deduplicate(artifact):
+    ''' Hardlink the files of an unpacked artifact to a store shared by all.
+
+    The store is artifacts/.cas, where each file is kept by its sha256 along
+    with the mode, owner and mtime, since a hardlink shares all of those.
+    The artifact's .manifest lists [path, object, mode] for each file, so
+    cull() can tell which objects nothing else is using any more.
+
+    '''
+    if not app.config.get('deduplicate'):
+        return
+
+    store = os.path.join(app.config['artifacts'], '.cas')
+    unpackdir = artifact + '.unpacked'
+    manifest = []
+    inodes = {}
+    for dirname, subdirs, files in os.walk(unpackdir):
+        dirinfo = os.lstat(dirname)
+        for filename in sorted(files):
+            path = os.path.join(dirname, filename)
+            info = os.lstat(path)
+            if not stat.S_ISREG(info.st_mode) or info.st_size == 0:
+                continue
+            sha = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    sha.update(chunk)
+            obj = '%s.%o.%s.%s.%s' % (sha.hexdigest(), info.st_mode,
+                                      info.st_uid, info.st_gid,
+                                      int(info.st_mtime))
+
+            # identical files in one artifact must stay separate, or they
+            # would be archived as hardlinks
+            if inodes.setdefault(obj, info.st_ino) != info.st_ino:
+                continue
+
+            objpath = os.path.join(store, obj[:2], obj)
+            try:
+                if not os.path.isdir(os.path.dirname(objpath)):
+                    os.makedirs(os.path.dirname(objpath))
+                os.link(path, objpath)
+            except OSError:
+                try:
+                    if not os.path.samefile(path, objpath):
+                        os.link(objpath, path + '.cas')
+                        os.rename(path + '.cas', path)
+                except OSError:
+                    continue  # eg too many links, so just keep our copy
+            manifest.append([os.path.relpath(path, unpackdir), obj,
+                             info.st_mode])
+        os.utime(dirname, (dirinfo.st_atime, dirinfo.st_mtime))
+
+    with open(artifact + '.manifest', 'w') as f:
+        json.dump(manifest, f)
+
+
+def release(artifact_dir, objects):
+    ''' Remove objects from the store if no artifact links to them now.
+
+    Returns how many were removed.
+
+    '''
+    removed = 0
+    for obj in objects:
+        objpath = os.path.join(artifact_dir, '.cas', obj[:2], obj)
+        try:
+            if os.stat(objpath).st_nlink == 1:
+                os.remove(objpath)
+                removed += 1
+        except OSError:
+            pass
+    return removed
+
+
 def upload(defs, this):
+    ''' Send an artifact to kbas, and return whether kbas now has it. '''
+
     cachefile = get_cache(defs, this)
+    checksum = get_checksum(cachefile)
     url = app.config['kbas-url'] + 'upload'
     params = {"filename": this['cache'],
               "password": app.config['kbas-password'],
-              "checksum": md5(cachefile)}
+              "checksum": checksum}
     with open(cachefile, 'rb') as f:
         try:
             response = requests.post(url=url, data=params, files={"file": f})
             if response.status_code == 201:
                 app.log(this, 'Uploaded %s to' % this['cache'], url)
-                return
+                return True
             if response.status_code == 777:
-                app.log(this, 'Reproduced %s at' % md5(cachefile),
-                        this['cache'])
-                app.config['reproduced'].append([md5(cachefile),
-                                                 this['cache']])
-                return
+                app.log(this, 'Reproduced %s at' % checksum, this['cache'])
+                app.config['reproduced'].append([checksum, this['cache']])
+                return True
             if response.status_code == 405:
                 # server has different md5 for this artifact
                 if this['kind'] == 'stratum':
@@ -187,11 +443,12 @@ def upload(defs, this):
                              'ERROR: stratum reproduction failed for',
                              this['cache'])
                 app.log(this, 'Artifact server already has', this['cache'])
-                return
+                return True
             app.log(this, 'Artifact server problem:', response.status_code)
         except:
             pass
         app.log(this, 'Failed to upload', this['cache'])
+        return False
 
 
 def get_cache(defs, this):
@@ -200,47 +457,192 @@ def get_cache(defs, this):
     if cache_key(defs, this) is False:
         return False
 
-    cachedir = os.path.join(app.config['artifacts'], cache_key(defs, this))
-    if os.path.isdir(cachedir):
-        call(['touch', cachedir])
-        artifact = os.path.join(cachedir, cache_key(defs, this))
-        unpackdir = artifact + '.unpacked'
-        if not os.path.isdir(unpackdir):
-            tempfile.tempdir = app.config['tmp']
-            tmpdir = tempfile.mkdtemp()
-            if call(['tar', 'xf', artifact, '--directory', tmpdir]):
-                app.log(this, 'Problem unpacking', artifact)
-                return False
-            try:
-                shutil.move(tmpdir, unpackdir)
-            except:
-                # corner case... if we are here ybd is multi-instance, this
-                # artifact was uploaded from somewhere, and more than one
-                # instance is attempting to unpack. another got there first
-                pass
-        return os.path.join(cachedir, cache_key(defs, this))
+    key = cache_key(defs, this)
+    if not in_index(key):
+        return False
 
-    return False
+    last_used.add(key)
+    artifact = os.path.join(app.config['artifacts'], key, key)
+    unpackdir = artifact + '.unpacked'
+    if not os.path.isdir(unpackdir):
+        # another instance may have culled it since we last looked
+        if not os.path.exists(artifact):
+            artifact_index.pop(key, None)
+            return False
+        tempfile.tempdir = app.config['tmp']
+        tmpdir = tempfile.mkdtemp()
+        try:
+            utils.extract(artifact, tmpdir)
+        except:
+            app.log(this, 'Problem unpacking', artifact)
+            return False
+        try:
+            shutil.move(tmpdir, unpackdir)
+            deduplicate(artifact)
+        except:
+            # corner case... if we are here ybd is multi-instance, this
+            # artifact was uploaded from somewhere, and more than one
+            # instance is attempting to unpack. another got there first
+            pass
+    return artifact
+
+
+def lock_unpacked(defs, this):
+    ''' Return this's .unpacked dir, and an open fd with a shared lock on it.
+
+    cull() leaves unpacked dirs alone while they are locked, so they can be
+    used as overlayfs layers for as long as the fd is open.
+
+    '''
+    while True:
+        if not get_cache(defs, this):
+            app.exit(this, 'ERROR: artifact was culled while staging',
+                     this['cache'])
+        unpackdir = get_cache(defs, this) + '.unpacked'
+        try:
+            fd = os.open(unpackdir, os.O_RDONLY)
+        except OSError:
+            continue  # culled since get_cache() looked, so unpack it again
+        fcntl.flock(fd, fcntl.LOCK_SH)
+        if os.path.isdir(unpackdir):
+            return unpackdir, fd
+        os.close(fd)
+
+
+def in_index(key):
+    ''' Check the artifact index for key, adding it if it's new on disk.
+
+    The index is loaded from the artifacts directory the first time we're
+    asked, so that we don't list it for every lookup. Other instances may
+    have added artifacts since, so we look for a missing key on disk before
+    saying no.
+
+    '''
+    if not artifact_index.get('.loaded'):
+        for artifact in os.listdir(app.config['artifacts']):
+            artifact_index[artifact] = True
+        artifact_index['.loaded'] = True
+
+    if key not in artifact_index and \
+            os.path.isdir(os.path.join(app.config['artifacts'], key)):
+        artifact_index[key] = True
+    return key in artifact_index
+
+
+def flush_last_used():
+    ''' Log the artifacts we've used as recent, so cull keeps them longer.
+
+    Lines are appended to .usage.log in a single write, so concurrent
+    workers and instances don't get in each other's way. cull() folds the
+    log into the usage index.
+
+    '''
+    if not last_used:
+        return
+    now = int(time.time())
+    lines = ''.join('%s %s\n' % (key, now) for key in last_used)
+    try:
+        with open(os.path.join(app.config['artifacts'], '.usage.log'),
+                  'a') as f:
+            f.write(lines)
+    except IOError:
+        pass
+    last_used.clear()
+
+
+def load_usage(artifact_dir):
+    ''' Return the usage index for artifact_dir, brought up to date.
+
+    The index maps each artifact to [last used, size, unpacked size]. Use
+    times come from .usage.log, so only artifacts which are new since the
+    last cull need a stat. Sizes are None until cull() has needed them;
+    artifacts never change, so once measured they are kept.
+
+    '''
+    usage = {}
+    try:
+        with open(os.path.join(artifact_dir, '.usage')) as f:
+            usage = json.load(f)
+    except:
+        pass
+
+    logfile = os.path.join(artifact_dir, '.usage.log')
+    used = {}
+    try:
+        os.rename(logfile, logfile + '.%s' % os.getpid())
+        with open(logfile + '.%s' % os.getpid()) as f:
+            for line in f:
+                key, when = line.split()
+                used[key] = max(used.get(key, 0), int(when))
+        os.remove(logfile + '.%s' % os.getpid())
+    except (IOError, OSError, ValueError):
+        pass
+
+    artifacts = [a for a in os.listdir(artifact_dir) if not a.startswith('.')]
+    usage = {a: usage.get(a) for a in artifacts}
+    for artifact in artifacts:
+        if usage[artifact] is None:
+            mtime = os.stat(os.path.join(artifact_dir, artifact)).st_mtime
+            usage[artifact] = [int(mtime), None, None]
+        usage[artifact][0] = max(usage[artifact][0], used.get(artifact, 0))
+    return usage
+
+
+def save_usage(artifact_dir, usage):
+    filename = os.path.join(artifact_dir, '.usage')
+    with open(filename + '.%s' % os.getpid(), 'w') as f:
+        json.dump(usage, f)
+    os.rename(filename + '.%s' % os.getpid(), filename)
 
 
 def get_metadata(defs, this):
     '''Load an individual .meta file
 
     The .meta file is expected to be in the .unpacked/baserock directory of the
-    built artifact
+    built artifact. It is parsed once, and kept in the artifact dir as a
+    .metadata file, which is much quicker to load next time.
 
     '''
+    try:
+        with open(get_cache(defs, this) + '.metadata', 'rb') as f:
+            return marshal.load(f)
+    except:
+        pass
+
     try:
         with open(get_metafile(defs, this), "r") as f:
             metadata = yaml.safe_load(f)
         if app.config.get('log-verbose'):
             app.log(this, 'Loaded metadata for', this['path'])
+        write_metadata_index(get_cache(defs, this), metadata)
         return metadata
     except:
         app.log(this, 'WARNING: problem loading metadata', this)
         return None
 
 
+def index_metadata(defs, this, artifact):
+    ''' Write the .metadata index for a new artifact, from its .meta file. '''
+
+    metafile = os.path.join(artifact + '.unpacked', 'baserock',
+                            defs.get(this)['name'] + '.meta')
+    try:
+        with open(metafile) as f:
+            write_metadata_index(artifact, yaml.safe_load(f))
+    except IOError:
+        pass  # eg systems, which don't have one
+
+
+def write_metadata_index(artifact, metadata):
+    try:
+        with open(artifact + '.metadata.%s' % os.getpid(), 'wb') as f:
+            marshal.dump(metadata, f)
+        os.rename(artifact + '.metadata.%s' % os.getpid(),
+                  artifact + '.metadata')
+    except (IOError, OSError, ValueError):
+        pass  # it's only an index, we can do without
+
+
 def get_metafile(defs, this):
     ''' Return the path to metadata file for this. '''
 
@@ -251,7 +653,7 @@ def get_metafile(defs, this):
 
 def get_remote(defs, this):
     ''' If a remote cached artifact exists for this, retrieve it '''
-    if app.config.get('last-retry-component') == this or this.get('tried'):
+    if this.get('tried'):
         return False
 
     if this.get('kind', 'chunk') != 'chunk':
@@ -273,7 +675,11 @@ def get_remote(defs, this):
             tmpdir = tempfile.mkdtemp()
             cachefile = os.path.join(tmpdir, cache_key(defs, this))
             with open(cachefile, 'wb') as f:
-                shutil.copyfileobj(response.raw, f)
+                # unpack as it arrives, saving the tarball on the way
+                os.makedirs(cachefile + '.unpacked')
+                f = utils.Checksum(f)
+                utils.extract(Tee(response.raw, f), cachefile + '.unpacked')
+            save_checksum(cachefile, f.hexdigest())
 
             return unpack(defs, this, cachefile)
 
@@ -283,41 +689,213 @@ def get_remote(defs, this):
     return False
 
 
-def cull(artifact_dir):
-    tempfile.tempdir = app.config['tmp']
-    deleted = 0
-
-    def clear(deleted, artifact_dir):
-        artifacts = utils.sorted_ls(artifact_dir)
-        for artifact in artifacts:
-            stat = os.statvfs(artifact_dir)
-            free = stat.f_frsize * stat.f_bavail / 1000000000
-            if free >= app.config.get('min-gigabytes', 10):
-                app.log('SETUP', '%sGB is enough free space' % free)
-                if deleted > 0:
-                    app.log('SETUP', 'Culled %s items in' % deleted,
-                            artifact_dir)
-                return True
-            path = os.path.join(artifact_dir, artifact)
-            if os.path.exists(os.path.join(path, artifact + '.unpacked')):
-                path = os.path.join(path, artifact + '.unpacked')
-            if os.path.exists(path) and artifact not in app.config['keys']:
-                tmpdir = tempfile.mkdtemp()
-                shutil.move(path, os.path.join(tmpdir, 'to-delete'))
-                app.remove_dir(tmpdir)
-                deleted += 1
-        return False
+class Tee(object):
+    ''' A file object which copies whatever is read from it to another. '''
+
+    def __init__(self, fileobj, copy):
+        self.fileobj = fileobj
+        self.copy = copy
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.copy.write(data)
+        return data
+
+
+def get_history():
+    ''' Return what was recorded about previous builds, keyed by name. '''
 
-    # cull unpacked dirs first
-    if clear(deleted, artifact_dir):
+    try:
+        with open(os.path.join(app.config['base'], 'history.json')) as f:
+            return json.load(f)
+    except:
+        return {}
+
+
+def record_history(this, item, value):
+    ''' Save a fact about this build (eg how long it took) for next time. '''
+
+    with open(os.path.join(app.config['base'], 'history.json'), 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        try:
+            history = json.load(f)
+        except:
+            history = {}
+        history.setdefault(this['name'], {})[item] = value
+        f.truncate(0)
+        json.dump(history, f, indent=1, sort_keys=True,
+                  separators=(',', ': '))
+
+
+def check_remotes(defs, components):
+    ''' Ask kbas which of these it has in one request, and note the answers
+
+    Older servers don't know this request, so then we leave has_remote() to
+    ask about each component separately.
+
+    '''
+    if not app.config.get('kbas-url') or app.config.get('reproduce'):
         return
 
-    # cull artifacts
-    if clear(deleted, artifact_dir):
+    chunks = [c for c in components
+              if c.get('kind', 'chunk') == 'chunk' and 'remote' not in c]
+    if chunks == []:
         return
 
+    try:
+        url = app.config['kbas-url'] + 'exists'
+        keys = [cache_key(defs, c) for c in chunks]
+        response = requests.post(url=url, json=keys)
+        found = set(response.json()['artifacts'])
+    except:
+        return
+
+    app.log('KBAS', 'Artifacts available from server:', len(found))
+    for chunk in chunks:
+        chunk['remote'] = cache_key(defs, chunk) in found
+
+
+def has_remote(defs, this):
+    ''' Check whether kbas has an artifact for this, without getting it '''
+    if 'remote' in this:
+        return this['remote']
+
+    this['remote'] = False
+    if this.get('kind', 'chunk') != 'chunk' or app.config.get('reproduce'):
+        return False
+
+    if app.config.get('kbas-url'):
+        try:
+            url = app.config['kbas-url'] + 'get/' + cache_key(defs, this)
+            this['remote'] = requests.head(url=url).status_code == 200
+        except:
+            app.log(this, 'WARNING: remote artifact server is not working')
+    return this['remote']
+
+
+def cull(artifact_dir):
+    ''' Delete the least recently used artifacts, if we're short of space.
+
+    Culling starts when there is less than 'min-gigabytes' free, and frees
+    enough to leave 'cull-gigabytes' free. Sizes and use times come from
+    the usage index, so we work out what to delete in one pass. Unpacked
+    dirs with a tarball go first, since they can be unpacked again. The
+    artifacts for the current target, any listed in 'pins', and any which
+    builds are using as overlayfs layers, are kept.
+
+    Everything to delete is moved to tmp at once, and removed in a forked
+    process while we get on with the build.
+
+    '''
+    tempfile.tempdir = app.config['tmp']
+    usage = load_usage(artifact_dir)
     stat = os.statvfs(artifact_dir)
-    free = stat.f_frsize * stat.f_bavail / 1000000000
+    free = stat.f_frsize * stat.f_bavail
+    low = app.config.get('min-gigabytes', 10) * 1000000000
+    if free >= low:
+        app.log('SETUP', '%sGB is enough free space' % (free / 1000000000))
+        save_usage(artifact_dir, usage)
+        return
+
+    pins = set(app.config.get('pins') or [])
+    keys = set(app.config['keys'])
+    candidates = sorted((a for a in usage if a not in keys and
+                         a not in pins and a.rsplit('.', 1)[0] not in pins),
+                        key=lambda a: usage[a][0])
+    high = max(app.config.get('cull-gigabytes', 0) * 1000000000, low)
+    needed = high - free
+    doomed = []
+    locks = {}
+
+    def in_use(unpacked):
+        ''' Lock unpacked until we're done, unless a build is using it. '''
+        if unpacked not in locks:
+            try:
+                locks[unpacked] = os.open(unpacked, os.O_RDONLY)
+                fcntl.flock(locks[unpacked], fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                locks[unpacked] = None  # not there to be used
+            except IOError:
+                os.close(locks[unpacked])
+                locks[unpacked] = False
+        return locks[unpacked] is False
+
+    def unpacked_size(artifact, unpacked):
+        if usage[artifact][2] is None:
+            usage[artifact][2] = utils.disk_usage(unpacked)
+        return usage[artifact][2]
+
+    for artifact in candidates:
+        if needed <= 0:
+            break
+        path = os.path.join(artifact_dir, artifact, artifact)
+        if os.path.isdir(path + '.unpacked') and os.path.exists(path) and \
+                not in_use(path + '.unpacked'):
+            needed -= unpacked_size(artifact, path + '.unpacked')
+            doomed.append((artifact, path + '.unpacked'))
+
+    # without the tarball, the unpacked dir is all there is
+    for artifact in candidates:
+        if needed <= 0:
+            break
+        path = os.path.join(artifact_dir, artifact)
+        unpacked = os.path.join(path, artifact + '.unpacked')
+        if os.path.isdir(unpacked) and in_use(unpacked):
+            continue
+        if usage[artifact][1] is None and not os.path.isdir(path):
+            usage[artifact][1] = utils.disk_usage(path)  # eg a build-log
+        elif usage[artifact][1] is None:
+            usage[artifact][1] = sum(utils.disk_usage(os.path.join(path, f))
+                                     for f in os.listdir(path)
+                                     if f != artifact + '.unpacked')
+        needed -= usage[artifact][1]
+        if (artifact, unpacked) in doomed:
+            doomed.remove((artifact, unpacked))
+        elif os.path.isdir(unpacked):
+            needed -= unpacked_size(artifact, unpacked)
+        doomed.append((artifact, path))
+        del usage[artifact]
+
+    tmpdir = tempfile.mkdtemp()
+    objects = []
+    for n, (artifact, path) in enumerate(doomed):
+        artifact_index.pop(artifact, None)
+        try:
+            manifest = os.path.join(artifact_dir, artifact,
+                                    artifact + '.manifest')
+            with open(manifest) as f:
+                objects += [obj for p, obj, mode in json.load(f)]
+        except:
+            pass
+        try:
+            os.rename(path, os.path.join(tmpdir, str(n)))
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                continue  # another instance got there first
+            # eg tmp is on another filesystem, so delete it here instead
+            app.log('SETUP', 'WARNING: unable to move %s to tmp:' % path, e)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+    for fd in locks.values():
+        if fd:
+            os.close(fd)
+    save_usage(artifact_dir, usage)
+    app.log('SETUP', 'Culling %s items from' % len(doomed), artifact_dir)
+
+    if os.fork() == 0:
+        app.remove_dir(tmpdir)
+        # objects can be left unused if ybd stopped before writing a
+        # manifest, so look for them too if this cull has freed any
+        if release(artifact_dir, objects) and app.config.get('deduplicate'):
+            store = os.path.join(artifact_dir, '.cas')
+            for dirname, subdirs, objects in os.walk(store):
+                release(artifact_dir, objects)
+        os._exit(0)
+
+    free = (high - max(needed, 0)) / 1000000000
     if free < app.config.get('min-gigabytes', 10):
         app.exit('SETUP', 'ERROR: %sGB is less than min-gigabytes:' % free,
                  app.config.get('min-gigabytes', 10))
@@ -325,19 +903,31 @@ def cull(artifact_dir):
 
 def check(artifact):
     try:
-        artifact = os.path.join(app.config['artifact-dir'], artifact,
-                                artifact)
-        checkfile = artifact + '.md5'
-        if not os.path.exists(checkfile):
-            checksum = md5(artifact)
-            with open(checkfile, "w") as f:
-                f.write(checksum)
-
-        return(open(checkfile).read())
+        return get_checksum(os.path.join(app.config['artifact-dir'], artifact,
+                                         artifact))
     except:
         return('================================')
 
 
+def get_checksum(artifact):
+    ''' Return the md5 of artifact, from the .md5 file kept beside it.
+
+    The checksum is normally saved as the artifact is written, downloaded
+    or uploaded, so it is only calculated here for older artifacts.
+
+    '''
+    checkfile = artifact + '.md5'
+    if not os.path.exists(checkfile):
+        save_checksum(artifact, md5(artifact))
+    with open(checkfile) as f:
+        return f.read()
+
+
+def save_checksum(artifact, checksum):
+    with open(artifact + '.md5', 'w') as f:
+        f.write(checksum)
+
+
 def md5(filename):
     # From http://stackoverflow.com/questions/3431825
     # answer by http://stackoverflow.com/users/370483/quantumsoup
@@ -0,0 +1,225 @@
+# Copyright (C) 2016  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# =*= License: GPL-2 =*=
+
+'''Share the build of a target between ybd workers on several machines.
+
+The coordinator works out the graph for the target and hands ready chunks
+to workers by cache key. Each worker builds what it is given, uploads it to
+kbas and reports back. A worker holds a lease on its chunk, which it renews
+while it builds, so if it dies the chunk is given to another worker.
+Dependencies are downloaded from kbas, so all the workers and the
+coordinator must be using the same definitions and the same kbas.
+
+'''
+
+import datetime
+import json
+import os
+import socket
+import time
+from urlparse import parse_qs, urlparse
+from wsgiref.simple_server import make_server, WSGIRequestHandler
+
+import requests
+
+import app
+from app import config, log
+from cache import cache_key, record_history
+from scheduler import critical_paths, graph, run
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass  # workers poll all the time, so don't log every request
+
+
+def coordinate(defs, target):
+    '''Serve ready components to workers until everything shareable is built.
+
+    Only chunks are downloaded from kbas, so strata, systems and clusters are
+    left for the coordinator to build itself afterwards. A chunk which needs
+    a stratum waits for all the chunks the stratum is waiting for.
+
+    Chunks are leased to workers for 'worker-lease-seconds' at a time. One
+    whose lease runs out is made ready again, for another worker.
+
+    '''
+    nodes = graph(defs, target)
+    waiting = {path: set() for path in nodes
+               if defs.get(path).get('kind', 'chunk') == 'chunk' and
+               not defs.get(path).get('remote')}
+
+    def chunks(deps):
+        for dep in deps:
+            if dep in waiting:
+                yield dep
+            else:
+                for chunk in chunks(nodes[dep]):
+                    yield chunk
+
+    for path in waiting:
+        waiting[path].update(chunks(nodes[path]))
+    lengths = critical_paths(defs, waiting)
+    lease = config.get('worker-lease-seconds', 300)
+    assigned = {}
+    failed = []
+
+    def next_job(worker):
+        ready = sorted((p for p in waiting if not waiting[p]),
+                       key=lambda p: (-lengths[p], p))
+        if ready == []:
+            return {}
+        path = ready[0]
+        del waiting[path]
+        assigned[path] = [worker, time.time() + lease]
+        log(path, 'Assigned to worker', worker)
+        return {'path': path, 'cache': defs.get(path)['cache'],
+                'lease': lease}
+
+    def renew(worker, path):
+        if assigned.get(path, [None])[0] != worker:
+            return {'status': 'expired'}
+        assigned[path][1] = time.time() + lease
+        return {'status': 'ok'}
+
+    def expire():
+        for path, (worker, expires) in assigned.items():
+            if expires < time.time():
+                log(path, 'WARNING: lease expired for worker', worker)
+                del assigned[path]
+                waiting[path] = set()
+
+    def job_done(job):
+        path = str(job['path'])
+        worker = assigned.get(path, [None])[0]
+        if job['status'] != 'ok':
+            if worker == job['worker']:
+                failed.append(job)  # exit once the worker has its response
+            return {}
+        if worker is None and path not in waiting:
+            return {}  # done already, by a worker which took over
+        assigned.pop(path, None)
+        waiting.pop(path, None)
+        log(path, 'Built by worker %s in seconds' % job['worker'],
+            job['duration'])
+        record_history(defs.get(path), 'duration', job['duration'])
+        defs.get(path).pop('remote', None)  # it should be on kbas now
+        for deps in waiting.values():
+            deps.discard(path)
+        return {}
+
+    def application(environ, start_response):
+        query = parse_qs(environ.get('QUERY_STRING', ''))
+        if environ['PATH_INFO'] == '/next':
+            result = next_job(query.get('worker', ['unknown'])[0])
+        elif environ['PATH_INFO'] == '/renew':
+            result = renew(query.get('worker', [None])[0],
+                           query.get('path', [None])[0])
+        elif environ['PATH_INFO'] == '/done':
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+            result = job_done(json.loads(environ['wsgi.input'].read(length)))
+        else:
+            start_response('404 Not Found', [])
+            return []
+        start_response('200 OK', [('Content-Type', 'application/json')])
+        return [json.dumps(result)]
+
+    url = urlparse(config['coordinator-url'])
+    server = make_server('', url.port or 80, application,
+                         handler_class=QuietHandler)
+    server.timeout = 1  # so leases are checked even if no one is calling
+    log('COORDINATOR', 'Components for workers to build:', len(waiting))
+    log('COORDINATOR', 'Serving workers at', config['coordinator-url'])
+    while waiting or assigned:
+        server.handle_request()
+        expire()
+        if failed:
+            server.server_close()
+            app.exit(failed[0]['path'], 'ERROR: build failed on worker',
+                     failed[0]['worker'])
+    server.server_close()
+    log(target, 'Workers are finished, building the rest locally')
+
+
+def work(defs, target):
+    '''Build whatever the coordinator hands us, until it has nothing left.'''
+
+    if config.get('kbas-password', 'insecure') == 'insecure' or \
+            config.get('kbas-url') is None:
+        app.exit('WORKER', 'ERROR: workers must be able to upload to',
+                 config.get('kbas-url'))
+
+    url = config['coordinator-url']
+    worker = '%s:%s' % (socket.gethostname(), os.getpid())
+    log('WORKER', 'I am worker %s for' % worker, url)
+    while True:
+        try:
+            job = requests.get(url=url + 'next', params={'worker': worker},
+                               timeout=60).json()
+        except:
+            log('WORKER', 'Coordinator has finished, or gone away', url)
+            return
+
+        if job == {}:
+            time.sleep(2)
+            continue
+
+        path = str(job['path'])
+        starttime = datetime.datetime.now()
+        status = 'failed'
+        if cache_key(defs, path) != job['cache']:
+            log(path, 'ERROR: coordinator has a different key', job['cache'])
+        else:
+            pid = os.fork()
+            if pid == 0:
+                run(defs, path)
+            if wait_renewing(url, worker, job, pid) == 0:
+                status = 'ok'
+
+        # always report back, so the coordinator doesn't wait for us forever
+        duration = datetime.datetime.now() - starttime
+        report = {'path': path, 'status': status, 'worker': worker,
+                  'duration': int(duration.total_seconds())}
+        try:
+            requests.post(url=url + 'done', data=json.dumps(report),
+                          timeout=60)
+        except requests.exceptions.RequestException:
+            log(path, 'WARNING: failed to report back to coordinator', url)
+        if status != 'ok':
+            app.exit(path, 'ERROR: failed to build', job['cache'])
+
+
+def wait_renewing(url, worker, job, pid):
+    '''Wait for the build of job, renewing its lease, and return its status.
+
+    If the lease can't be renewed in time the coordinator may give the job to
+    another worker, but we carry on, since this build may still be first.
+
+    '''
+    renew_at = time.time() + job['lease'] / 3
+    while True:
+        done, status = os.waitpid(pid, os.WNOHANG)
+        if done:
+            return status
+        time.sleep(1)
+        if time.time() < renew_at:
+            continue
+        renew_at = time.time() + job['lease'] / 3
+        try:
+            requests.get(url=url + 'renew', timeout=60,
+                         params={'worker': worker, 'path': job['path']})
+        except requests.exceptions.RequestException:
+            log(job['path'], 'WARNING: failed to renew lease with', url)
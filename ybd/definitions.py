@@ -18,10 +18,9 @@ import yaml
 import os
 import app
 import cache
-from subprocess import check_output, PIPE
-import hashlib
 import defaults
 import jsonschema
+import utils
 
 
 class Definitions(object):
@@ -30,28 +29,28 @@ class Definitions(object):
         '''Load all definitions from a directory tree.'''
         self._definitions = {}
         self._trees = {}
+        self._files = {}
+        self._sources = {}
 
         schemas = self.load_schemas()
         with app.chdir(directory):
-            for dirname, dirnames, filenames in os.walk('.'):
-                filenames.sort()
-                dirnames.sort()
-                if '.git' in dirnames:
-                    dirnames.remove('.git')
-                for filename in filenames:
-                    if filename.endswith(('.def', '.morph')):
-                        path = os.path.join(dirname, filename)
-                        data = self._load(path)
-                        if data is not None:
-                            self.validate_schema(schemas, data)
-                            data['path'] = path[2:]
-                            self._fix_keys(data)
-                            self._tidy_and_insert_recursively(data)
+            for path, info in utils.find_files('.', ('.def', '.morph')):
+                self._files[path] = info
+                data = self._load(path)
+                if data is not None:
+                    self.validate_schema(schemas, data)
+                    data['path'] = path
+                    self._fix_keys(data)
+                    self._tidy_and_insert_recursively(data)
+                    self._sources[path] = ([data['path']] +
+                                           data.get('contents', []))
 
         self.defaults = defaults.Defaults()
 
-        caches_are_valid = self._check_trees()
+        changed = self._check_trees()
         for path in self._definitions:
+            if path in changed:
+                continue
             try:
                 this = self._definitions[path]
                 if this.get('ref') and self._trees.get(path):
@@ -226,41 +225,39 @@ class Definitions(object):
         return self._definitions.get(definition['path'])
 
     def _check_trees(self):
-        '''True if the .trees file matches the current working subdirectories
+        '''Load the .trees file, and return the definitions changed since.
 
-        The .trees file lists all git trees for a set of definitions, and a
-        checksum of the checked-out subdirectories when we calculated them.
+        The .trees file lists all git trees for a set of definitions, and the
+        size, mtime and inode of each definition file when we saved it.
 
-        If the checksum for the current subdirectories matches, return True
+        Definitions from files which don't match are returned, so we don't
+        trust their old trees.
 
         '''
         try:
-            with app.chdir(app.config['defdir']):
-                checksum = check_output('ls -lRA */', shell=True)
-            checksum = hashlib.md5(checksum).hexdigest()
             with open('.trees') as f:
                 text = f.read()
             self._trees = yaml.safe_load(text)
-            if self._trees.get('.checksum') == checksum:
-                return True
+            files = self._trees.pop('.files')
         except:
             self._trees = {}
+            return set()
 
-        return False
+        changed = set()
+        for path in self._files:
+            if files.get(path) != self._files[path]:
+                changed.update(self._sources.get(path, []))
+        app.log('DEFINITIONS', 'Definitions changed since last run:',
+                len(changed))
+        return changed
 
     def save_trees(self):
         '''Creates the .trees file for the current working directory
 
-        .trees contains a list of git trees for all the definitions, and a
-        checksum for the state of the working subdirectories
+        .trees contains a list of git trees for all the definitions, and the
+        size, mtime and inode of each definition file
         '''
-        with app.chdir(app.config['defdir']):
-            try:
-                checksum = check_output('ls -lRA */', shell=True)
-            except:
-                checksum = check_output('ls -lRA .', shell=True)
-        checksum = hashlib.md5(checksum).hexdigest()
-        self._trees = {'.checksum': checksum}
+        self._trees = {'.files': self._files}
         for name in self._definitions:
             if self._definitions[name].get('tree') is not None:
                 self._trees[name] = [self._definitions[name]['ref'],
@@ -19,7 +19,9 @@ import json
 import re
 import shutil
 import string
-from subprocess import call, check_output, check_call
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from subprocess import call, check_output, check_call, Popen, PIPE
 import sys
 
 import requests
@@ -36,6 +38,8 @@ else:
     from configparser import RawConfigParser
     from io import StringIO
 
+session = requests.Session()
+
 
 def get_repo_url(repo):
     for alias, url in app.config.get('aliases', {}).items():
@@ -75,18 +79,120 @@ def get_version(gitdir, ref='HEAD'):
     return result
 
 
+def get_gitdir(repo):
+    if repo.startswith('file://') or repo.startswith('/'):
+        return repo.replace('file://', '')
+    return os.path.join(app.config['gits'], get_repo_name(repo))
+
+
+def get_trees(defs, target):
+    '''Resolve the trees for everything target needs, in as few calls as we can.
+
+    Refs are looked up with a single git cat-file for each local mirror, with
+    the mirrors in parallel, and the rest are asked of the tree-server in one
+    request. Anything still unresolved is left for get_tree() to deal with.
+
+    '''
+    mirrors = {}
+    for this in needs_tree(defs, target):
+        mirrors.setdefault(get_gitdir(this['repo']), []).append(this)
+
+    remote = []
+    for gitdir in [d for d in mirrors if not os.path.exists(d)]:
+        remote += mirrors.pop(gitdir)
+    if remote and app.config.get('tree-server'):
+        query_tree_server(remote)
+    if mirrors:
+        pool = ThreadPool(min(len(mirrors), cpu_count()))
+        pool.map(lambda item: resolve_refs(*item), mirrors.items())
+        pool.close()
+
+
+def needs_tree(defs, target):
+    '''Return the components for target with a ref but no tree yet.'''
+
+    components = []
+    seen = set()
+
+    def walk(path):
+        this = defs.get(path)
+        if this['path'] in seen or \
+                this.get('arch', app.config['arch']) != app.config['arch']:
+            return
+        seen.add(this['path'])
+        if this.get('repo') and this.get('ref') and not this.get('tree'):
+            components.append(this)
+        for dep in this.get('build-depends', []) + this.get('contents', []):
+            walk(dep)
+        for system in this.get('systems', []):
+            walk_system(system)
+
+    def walk_system(system):
+        walk(system['path'])
+        for subsystem in system.get('subsystems', []):
+            walk_system(subsystem)
+
+    walk(target)
+    return components
+
+
+def resolve_refs(gitdir, components):
+    '''Look up the trees for components' refs with one git cat-file.'''
+
+    refs = ''.join(this['ref'] + '^{tree}\n' for this in components)
+    with open(os.devnull, "w") as fnull:
+        git = Popen(['git', 'cat-file', '--batch-check'], cwd=gitdir,
+                    stdin=PIPE, stdout=PIPE, stderr=fnull)
+        output = git.communicate(refs)[0].splitlines()
+    for this, line in zip(components, output):
+        fields = line.split()
+        if len(fields) == 3 and fields[1] == 'tree':
+            this['tree'] = fields[0]
+
+
+def query_tree_server(components):
+    '''Ask the tree-server for components' trees, in one request if we can.
+
+    Servers which don't take a list are asked for each tree separately, over
+    the same pooled connections.
+
+    '''
+    queries = [{'repo': get_repo_url(this['repo']), 'ref': this['ref']}
+               for this in components]
+    try:
+        r = session.post(url=app.config['tree-server'], json=queries)
+        results = r.json()
+        for this, result in zip(components, results):
+            if result.get('tree'):
+                this['tree'] = result['tree']
+        return
+    except:
+        pass
+
+    def get(item):
+        this, params = item
+        try:
+            r = session.get(url=app.config['tree-server'], params=params)
+            this['tree'] = r.json()['tree']
+        except:
+            pass
+
+    pool = ThreadPool(min(len(components), cpu_count()))
+    pool.map(get, zip(components, queries))
+    pool.close()
+
+
 def get_tree(this):
     ref = this['ref']
-    gitdir = os.path.join(app.config['gits'], get_repo_name(this['repo']))
+    gitdir = get_gitdir(this['repo'])
     if this['repo'].startswith('file://') or this['repo'].startswith('/'):
-        gitdir = this['repo'].replace('file://', '')
         if not os.path.isdir(gitdir):
             app.exit(this, 'ERROR: git repo not found:', this['repo'])
 
     if not os.path.exists(gitdir):
         try:
             params = {'repo': get_repo_url(this['repo']), 'ref': ref}
-            r = requests.get(url=app.config['tree-server'], params=params)
+            r = session.get(url=app.config['tree-server'], params=params)
             return r.json()['tree']
         except:
             if app.config.get('tree-server'):
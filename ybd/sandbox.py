@@ -17,11 +17,16 @@
 
 import sandboxlib
 import contextlib
+import errno
+import fcntl
+import hashlib
+import json
 import os
 import pipes
 import shutil
 import stat
 import tempfile
+import threading
 from subprocess import call, PIPE
 
 import app
@@ -34,6 +39,16 @@ from repos import get_repo_url
 # can be used.
 executor = None
 
+# Path of a FIFO used as a GNU make jobserver shared by all builds, if any.
+jobserver = None
+
+# Whether overlayfs mounts work here, once we have tried one.
+overlay = None
+
+
+class TmpfsFull(Exception):
+    '''A build failed because it ran out of space on its tmpfs.'''
+
 
 @contextlib.contextmanager
 def setup(this):
@@ -41,7 +56,6 @@ def setup(this):
     tempfile.tempdir = app.config['tmp']
     this['sandbox'] = tempfile.mkdtemp()
     os.environ['TMPDIR'] = app.config['tmp']
-    app.config['sandboxes'] += [this['sandbox']]
     this['build'] = os.path.join(this['sandbox'], this['name'] + '.build')
     this['install'] = os.path.join(this['sandbox'], this['name'] + '.inst')
     this['baserockdir'] = os.path.join(this['install'], 'baserock')
@@ -58,8 +72,6 @@ def setup(this):
 
     try:
         yield
-    except app.RetryException as e:
-        raise e
     except:
         import traceback
         app.log(this, 'ERROR: a surprise exception happened', '')
@@ -70,11 +82,21 @@ def setup(this):
 
     if app.config.get('log-verbose'):
         app.log(this, "Removing sandbox dir", this['sandbox'])
+    unmount_tmpfs(this)
+    if this.pop('overlay', None):
+        call(['umount', this['sandbox']])
+        for suffix in ['.upper', '.work', '.layers']:
+            app.remove_dir(this['sandbox'] + suffix)
+    if this.get('snapshot'):
+        this.pop('snapshot').close()  # let it be culled again
+    for lock in this.pop('layer-locks', []):
+        os.close(lock)
     app.remove_dir(this['sandbox'])
 
 
-def install(defs, this, component):
-    # populate this['sandbox'] with the artifact files from component
+def install(defs, this, component, copy=False):
+    # populate this['sandbox'] with the artifact files from component, copied
+    # if this will change them in place, or else hardlinked from the cache
     if os.path.exists(os.path.join(this['sandbox'], 'baserock',
                                    component['name'] + '.meta')):
         return
@@ -83,12 +105,261 @@ def install(defs, this, component):
     if cache.get_cache(defs, component) is False:
         app.exit(this, 'ERROR: unable to get cache for', component['name'])
     unpackdir = cache.get_cache(defs, component) + '.unpacked'
-    if this.get('kind') is 'system':
+    if this.get('kind', 'chunk') == 'chunk' and app.config.get('overlay'):
+        # stage() will mount it, but link the .meta now so we know it's in.
+        # the lock stops it being culled until the sandbox is removed
+        layers = this.setdefault('layers', [])
+        if unpackdir not in layers:
+            unpackdir, lock = cache.lock_unpacked(defs, component)
+            this.setdefault('layer-locks', []).append(lock)
+            layers.append(unpackdir)
+        metafile = os.path.join('baserock', component['name'] + '.meta')
+        if os.path.exists(os.path.join(unpackdir, metafile)):
+            utils.hardlink_file_list(unpackdir, this['sandbox'], [metafile])
+        return
+    if copy:
         utils.copy_all_files(unpackdir, this['sandbox'])
     else:
         utils.hardlink_all_files(unpackdir, this['sandbox'])
 
 
+def stage(this):
+    '''Make the dependencies installed for this visible in its sandbox.
+
+    Each dependency's .unpacked dir becomes a read-only overlayfs layer under
+    the sandbox, so staging takes one mount however many files there are, and
+    the build can't change the artifacts. If overlayfs can't be used, the
+    files are hardlinked in the same order instead.
+
+    If there's more than one dependency they are merged into a snapshot
+    first, which other chunks with the same dependencies can use as it is.
+    Then the build and install dirs go on tmpfs, if they fit.
+
+    '''
+    layers = this.pop('layers', [])
+    if len(layers) > 1 and app.config.get('staging-snapshots'):
+        layers = [snapshot(this, layers)]
+    if layers and not mount_overlay(this, layers):
+        for unpackdir in layers:
+            utils.hardlink_all_files(unpackdir, this['sandbox'])
+    mount_tmpfs(this)
+
+
+def snapshot(this, layers):
+    '''Return a dir with all the layers hardlinked into it, making it if need be.
+
+    Chunks in a stratum often have exactly the same dependencies, so the
+    merged tree is kept in artifacts/.staging, named by a hash of the layers
+    in order, for the next build which needs them. The most recently used
+    'staging-snapshots' are kept. Each build holds a shared lock on its
+    snapshot until the sandbox is removed, so it isn't culled while in use.
+
+    '''
+    store = os.path.join(app.config['artifacts'], '.staging')
+    if not os.path.isdir(store):
+        os.makedirs(store)
+    path = os.path.join(store, hashlib.sha1('\n'.join(layers)).hexdigest())
+    while True:
+        this['snapshot'] = open(path + '.lock', 'a')
+        fcntl.flock(this['snapshot'], fcntl.LOCK_SH)
+        try:
+            if (os.fstat(this['snapshot'].fileno()).st_ino ==
+                    os.stat(path + '.lock').st_ino):
+                break
+        except OSError:
+            pass
+        this['snapshot'].close()  # the lock was removed with its snapshot
+    if os.path.isdir(path):
+        os.utime(path, None)
+        if app.config.get('log-verbose'):
+            app.log(this, 'Using staging snapshot', path)
+        return path
+
+    tmpdir = tempfile.mkdtemp(dir=store)
+    for unpackdir in layers:
+        utils.hardlink_all_files(unpackdir, tmpdir)
+    try:
+        os.rename(tmpdir, path)
+        app.log(this, 'Created staging snapshot', path)
+    except OSError:
+        shutil.rmtree(tmpdir)  # another build made it first
+
+    snapshots = [os.path.join(store, s) for s in os.listdir(store)
+                 if not s.endswith('.lock') and not s.startswith('tmp')]
+    try:
+        snapshots.sort(key=os.path.getmtime)
+    except OSError:
+        return path  # someone else is culling
+    for old in snapshots[:-app.config['staging-snapshots']]:
+        with open(old + '.lock', 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                continue  # in use
+            doomed = tempfile.mkdtemp(dir=store)
+            try:
+                os.rename(old, doomed)
+                os.remove(old + '.lock')
+            except OSError:
+                pass  # someone else is culling
+        shutil.rmtree(doomed, ignore_errors=True)
+    return path
+
+
+def mount_overlay(this, layers):
+    global overlay
+    if overlay is False or len(layers) > 500:  # the kernel's limit
+        return False
+
+    # what was in the sandbox becomes the writable layer. layers are named
+    # by number so that hundreds of them fit in the mount options, and the
+    # last to be installed goes on top, as it would with hardlinks
+    sandbox = this['sandbox']
+    os.rename(sandbox, sandbox + '.upper')
+    for directory in [sandbox, sandbox + '.work', sandbox + '.layers']:
+        os.mkdir(directory)
+    for n, unpackdir in enumerate(layers):
+        os.symlink(unpackdir, os.path.join(sandbox + '.layers', str(n)))
+    options = 'lowerdir=%s,upperdir=%s,workdir=%s' % (
+        ':'.join(str(n) for n in reversed(range(len(layers)))),
+        sandbox + '.upper', sandbox + '.work')
+    with app.chdir(sandbox + '.layers'), open(this['log'], 'a') as logfile:
+        failed = call(['mount', '-t', 'overlay', 'overlay', '-o', options,
+                       sandbox], stdout=logfile, stderr=logfile)
+
+    if failed:
+        os.rmdir(sandbox)
+        os.rename(sandbox + '.upper', sandbox)
+        app.remove_dir(sandbox + '.work')
+        app.remove_dir(sandbox + '.layers')
+        app.log(this, 'WARNING: overlayfs is not working, hardlinking instead')
+        overlay = False
+        return False
+
+    # ybd writes the artifact itself, so it works in the writable layer
+    # directly. that's also where it can be moved into the cache from
+    overlay = this['overlay'] = True
+    for directory in ['install', 'baserockdir', 'tmp']:
+        this[directory] = os.path.join(sandbox + '.upper',
+                                       os.path.relpath(this[directory],
+                                                       sandbox))
+    if app.config.get('log-verbose'):
+        app.log(this, 'Staged %s layers with overlayfs' % len(layers))
+    return True
+
+
+def mount_tmpfs(this):
+    '''Put this chunk's build and install dirs on tmpfs, if they should fit.
+
+    Each is given twice the space it used the last time this chunk was built,
+    and all builds using the same tmp dir share 'tmpfs-megabytes' between
+    them, so a big chunk can't use up the memory. Chunks which haven't been
+    built before, or don't fit, or filled their tmpfs before, go on disk.
+
+    '''
+    history = cache.get_history().get(this['name'], {})
+    if not app.config.get('tmpfs-megabytes') or history.get('tmpfs') is False:
+        return
+    try:
+        sizes = {directory: 2 * history[directory + '-megabytes']
+                 for directory in ['build', 'install']}
+    except KeyError:
+        return
+
+    # with overlayfs, the tmpfs has to go on top of the merged tree
+    paths = {'build': this['build'],
+             'install': os.path.join(this['sandbox'], this['name'] + '.inst')}
+    with tmpfs_reservations() as reserved:
+        used = sum(megabytes for pid, megabytes in reserved.values())
+        if used + sum(sizes.values()) > app.config['tmpfs-megabytes']:
+            if app.config.get('log-verbose'):
+                app.log(this, 'Not enough tmpfs left, building on disk')
+            return
+        this['tmpfs'] = []
+        for directory in ['build', 'install']:
+            mode = stat.S_IMODE(os.stat(paths[directory]).st_mode)
+            options = 'size=%sm,mode=%o' % (sizes[directory], mode)
+            with open(this['log'], 'a') as logfile:
+                if call(['mount', '-t', 'tmpfs', '-o', options, 'tmpfs',
+                         paths[directory]], stdout=logfile, stderr=logfile):
+                    for path in this.pop('tmpfs'):
+                        call(['umount', path])
+                    app.log(this, 'WARNING: tmpfs is not working, '
+                            'building on disk')
+                    app.config['tmpfs-megabytes'] = 0
+                    return
+            this['tmpfs'].append(paths[directory])
+        reserved[this['sandbox']] = [os.getpid(), sum(sizes.values())]
+
+    this['install'] = paths['install']
+    this['baserockdir'] = os.path.join(this['install'], 'baserock')
+    os.makedirs(this['baserockdir'])
+    if app.config.get('log-verbose'):
+        app.log(this, 'Building on tmpfs, megabytes', sum(sizes.values()))
+
+
+def unmount_tmpfs(this):
+    '''Put this chunk's build and install dirs back on disk, empty.'''
+
+    if not this.get('tmpfs'):
+        return
+    for path in this.pop('tmpfs'):
+        call(['umount', path])
+    with tmpfs_reservations() as reserved:
+        reserved.pop(this['sandbox'], None)
+    if not os.path.isdir(this['baserockdir']):
+        os.makedirs(this['baserockdir'])
+
+
+@contextlib.contextmanager
+def tmpfs_reservations():
+    '''Lock and yield the tmpfs megabytes reserved by each sandbox.'''
+
+    with open(os.path.join(app.config['tmp'], '.tmpfs'), 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        try:
+            reserved = json.load(f)
+        except ValueError:
+            reserved = {}
+        for sandbox, (pid, megabytes) in reserved.items():
+            try:
+                os.kill(pid, 0)
+            except OSError as e:
+                if e.errno == errno.ESRCH:
+                    del reserved[sandbox]  # its build failed
+        yield reserved
+        f.truncate(0)
+        json.dump(reserved, f)
+
+
+def create_jobserver():
+    '''Create a pool of make job tokens shared by all builds in this run.
+
+    sandboxlib closes inherited file descriptors, so the pool is a FIFO which
+    each build opens as fds 3 and 4. A FIFO drops its contents once nobody has
+    it open, so we hold it open until ybd exits. Each make gets one job for
+    free, so the pool holds a token for each of the rest.
+
+    '''
+    global jobserver
+
+    jobserver = os.path.join(app.config['tmp'], 'jobserver.%s' % os.getpid())
+    os.mkfifo(jobserver)
+    fd = os.open(jobserver, os.O_RDWR)
+    instances = app.config.get('instances', 1)
+    tokens = app.config['max-jobs'] * instances - instances
+    os.write(fd, '+' * tokens)
+    app.log('SETUP', 'Jobserver has %s tokens at' % tokens, jobserver)
+
+
+def remove_jobserver():
+    '''Remove the jobserver FIFO, once nothing else will need it.'''
+
+    if jobserver and os.path.exists(jobserver):
+        os.remove(jobserver)
+
+
 def ldconfig(this):
     conf = os.path.join(this['sandbox'], 'etc', 'ld.so.conf')
     if os.path.exists(conf):
@@ -112,6 +383,54 @@ def run_sandboxed(this, command, env=None, allow_parallel=False):
     with open(this['log'], "a") as logfile:
         logfile.write("# # %s\n" % command)
 
+    argv = ['sh', '-c', command]
+    if allow_parallel and jobserver and not this.get('max-jobs'):
+        fifo = jobserver
+        if this.get('build-mode') != 'bootstrap':
+            name = os.path.basename(jobserver)
+            fifo = os.path.join('/tmp', name)
+            if not os.path.exists(os.path.join(this['tmp'], name)):
+                os.link(jobserver, os.path.join(this['tmp'], name))
+        argv = ['sh', '-c', 'exec 3<>%s 4<>%s; %s' % (fifo, fifo, command)]
+
+    cur_makeflags = env.get("MAKEFLAGS")
+
+    try:
+        if not allow_parallel:
+            env.pop("MAKEFLAGS", None)
+
+        if this.get('session'):
+            exit_code = this['session'](argv, env)
+        else:
+            config = sandbox_config(this, env)
+            app.log_env(this['log'], env, argv_to_string(argv))
+
+            with open(this['log'], "a") as logfile:
+                exit_code = executor.run_sandbox_with_redirection(
+                    argv, stdout=logfile, stderr=sandboxlib.STDOUT,
+                    env=env, **config)
+
+        if exit_code != 0:
+            for path in this.get('tmpfs', []):
+                fs = os.statvfs(path)
+                if fs.f_bavail * fs.f_frsize < 1024 * 1024:
+                    cache.record_history(this, 'tmpfs', False)
+                    app.log(this, 'WARNING: %s filled its tmpfs, so it will '
+                            'be built on disk from now on' % this['name'])
+                    raise TmpfsFull(path)
+            app.log(this, 'ERROR: command failed in directory %s:\n\n' %
+                    os.getcwd(), argv_to_string(argv))
+            call(['tail', '-n', '200', this['log']])
+            app.log(this, 'ERROR: log file is at', this['log'])
+            app.exit(this, 'ERROR: sandbox debris is at', this['sandbox'])
+    finally:
+        if cur_makeflags is not None:
+            env['MAKEFLAGS'] = cur_makeflags
+
+
+def sandbox_config(this, env):
+    '''Return the sandboxlib settings for running this's commands.'''
+
     mounts = ccache_mounts(this, ccache_target=env['CCACHE_DIR'])
 
     if this.get('build-mode') == 'bootstrap':
@@ -154,34 +473,94 @@ def run_sandboxed(this, command, env=None, allow_parallel=False):
             network='isolated',
         )
 
-    argv = ['sh', '-c', command]
-
-    cur_makeflags = env.get("MAKEFLAGS")
-
     # Adjust config for what the backend is capable of. The user will be warned
     # about any changes made.
     config = executor.degrade_config_for_capabilities(config, warn=False)
+    return config
 
-    try:
-        if not allow_parallel:
-            env.pop("MAKEFLAGS", None)
-
-        app.log_env(this['log'], env, argv_to_string(argv))
 
-        with open(this['log'], "a") as logfile:
-            exit_code = executor.run_sandbox_with_redirection(
-                argv, stdout=logfile, stderr=sandboxlib.STDOUT,
-                env=env, **config)
+@contextlib.contextmanager
+def session(this, env):
+    '''Run this's build commands with one shell in one sandbox, if configured.
+
+    Otherwise every command gets a sandbox of its own, which takes most of the
+    time for short ones. With 'sandbox-session' the shell is started for the
+    first command, and run_sandboxed() hands it each command through a FIFO
+    in the sandbox's /tmp, getting the exit code back through another. Each
+    command reads an empty here-document on stdin, not the FIFO, since there
+    may be no /dev/null. The shell stops after a command fails, as ybd will
+    exit.
+
+    '''
+    if not app.config.get('sandbox-session'):
+        yield
+        return
 
-        if exit_code != 0:
-            app.log(this, 'ERROR: command failed in directory %s:\n\n' %
-                    os.getcwd(), argv_to_string(argv))
-            call(['tail', '-n', '200', this['log']])
-            app.log(this, 'ERROR: log file is at', this['log'])
-            app.exit(this, 'ERROR: sandbox debris is at', this['sandbox'])
+    tmp = os.path.join(this['sandbox'], 'tmp')
+    inside = tmp if this.get('build-mode') == 'bootstrap' else '/tmp'
+    fifos = {}
+    for name in ['commands', 'results']:
+        os.mkfifo(os.path.join(tmp, 'ybd-' + name))
+        fifos[name] = os.open(os.path.join(tmp, 'ybd-' + name), os.O_RDWR)
+    results = os.fdopen(fifos['results'], 'r', 0)
+    script = ('exec 5>%s/ybd-results 6<%s/ybd-commands\n'
+              'while read -r command <&6 && [ "$command" != exit ]; do\n'
+              '    (. "$command") 5>&- 6<&- <<EOF\n'
+              'EOF\n'
+              '    status=$?\n'
+              '    echo $status >&5\n'
+              '    [ $status = 0 ] || exit $status\n'
+              'done\n' % (inside, inside))
+    shell_argv = ['sh', '-c', script]
+    session_env = dict(env)
+    shell = []
+
+    def run_shell():
+        exit_code = 1
+        try:
+            with open(this['log'], "a") as logfile:
+                exit_code = executor.run_sandbox_with_redirection(
+                    shell_argv, stdout=logfile, stderr=sandboxlib.STDOUT,
+                    env=session_env, **config)
+        finally:
+            os.write(fifos['results'], 'exit %s\n' % exit_code)
+
+    def run_command(argv, env):
+        if not shell:
+            app.log_env(this['log'], session_env,
+                        argv_to_string(shell_argv))
+            shell.append(threading.Thread(target=run_shell))
+            shell[0].start()
+        with open(os.path.join(tmp, 'ybd-command'), 'w') as f:
+            for key in session_env:
+                if key not in env:
+                    f.write('unset %s\n' % key)
+            for key, value in env.items():
+                if session_env.get(key) != value:
+                    f.write('export %s=%s\n' % (key, pipes.quote(value)))
+            f.write(argv_to_string(argv) + '\n')
+        os.write(fifos['commands'], '%s/ybd-command\n' % inside)
+        result = results.readline().split()
+        if result[0] == 'exit':  # the shell didn't start, or was killed
+            return int(result[1]) or 1
+        if result[0] != '0':
+            shell[0].join()  # let sandboxlib unmount before ybd exits
+        return int(result[0])
+
+    config = sandbox_config(this, env)
+    this['session'] = run_command
+    try:
+        yield
     finally:
-        if cur_makeflags is not None:
-            env['MAKEFLAGS'] = cur_makeflags
+        del this['session']
+        os.write(fifos['commands'], 'exit\n')
+        if shell:
+            shell[0].join()
+        results.close()
+        os.close(fifos['commands'])
+        for name in ['commands', 'results', 'command']:
+            if os.path.exists(os.path.join(tmp, 'ybd-' + name)):
+                os.remove(os.path.join(tmp, 'ybd-' + name))
 
 
 def run_logged(this, cmd_list):
@@ -301,6 +680,8 @@ def env_vars_for_build(defs, this):
     env['PREFIX'] = this.get('prefix') or '/usr'
     env['MAKEFLAGS'] = '-j%s' % (this.get('max-jobs') or
                                  app.config['max-jobs'])
+    if jobserver and not this.get('max-jobs'):
+        env['MAKEFLAGS'] = '--jobserver-fds=3,4 -j'
     env['TERM'] = 'dumb'
     env['SHELL'] = '/bin/sh'
     env['USER'] = env['USERNAME'] = env['LOGNAME'] = 'tomjon'
@@ -0,0 +1,235 @@
+# Copyright (C) 2016  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# =*= License: GPL-2 =*=
+
+'''Build a target by dispatching ready components to forked workers.
+
+The dependency graph is calculated once from the definitions and the cache
+keys. A component is ready when everything it depends on is cached, so each
+worker only ever composes a single component and nothing is built twice.
+With one instance, components are built in this process instead, so what it
+has found out (the artifact index, staging lists, remote checks) is kept.
+
+'''
+
+import os
+import signal
+import app
+from app import config, log
+from cache import cache_key, get_cache, get_history
+from cache import check_remotes, flush_last_used, has_remote
+from cache import archive_done, wait_for_archives
+
+
+def dependencies(defs, component):
+    '''Return the paths which must be cached before component can be built.'''
+
+    component = defs.get(component)
+    deps = component.get('build-depends', []) + component.get('contents', [])
+
+    def add_system_recursively(system):
+        deps.append(system['path'])
+        for subsystem in system.get('subsystems', []):
+            add_system_recursively(subsystem)
+
+    for system in component.get('systems', []):
+        add_system_recursively(system)
+
+    return deps
+
+
+def graph(defs, target):
+    '''Map each component we need to build to the paths it is waiting for.
+
+    Components which are already cached, or which can't be built for this
+    arch, are left out along with everything below them. Components which
+    can be downloaded from kbas don't wait for anything.
+
+    '''
+
+    def walk(path, nodes, prune):
+        component = defs.get(path)
+        if component['path'] in nodes:
+            return
+        if cache_key(defs, component) is False or get_cache(defs, component):
+            return
+        nodes[component['path']] = set()
+        if prune and has_remote(defs, component):
+            return
+        for dep in dependencies(defs, component):
+            walk(dep, nodes, prune)
+            if defs.get(dep)['path'] in nodes:
+                nodes[component['path']].add(defs.get(dep)['path'])
+
+    missing = {}
+    walk(target, missing, False)
+    check_remotes(defs, [defs.get(path) for path in missing])
+
+    nodes = {}
+    walk(target, nodes, True)
+    return nodes
+
+
+def get_duration(defs, path, history):
+    '''Estimate the seconds it will take to build path, or 0 to download.'''
+
+    component = defs.get(path)
+    if component.get('remote'):
+        return 0
+    return history.get(component['name'], {}).get('duration', 1)
+
+
+def critical_paths(defs, nodes):
+    '''Estimate the seconds from starting each node to finishing them all.
+
+    Durations come from the history of previous builds. The node with the
+    longest remaining path is the one most likely to stretch the whole build,
+    so it should be started first.
+
+    '''
+    history = get_history()
+    dependents = {path: [] for path in nodes}
+    for path, deps in nodes.items():
+        for dep in deps:
+            dependents[dep].append(path)
+
+    lengths = {}
+
+    def length(path):
+        if path not in lengths:
+            duration = get_duration(defs, path, history)
+            lengths[path] = duration + max([length(p) for p in
+                                            dependents[path]] or [0])
+        return lengths[path]
+
+    for path in nodes:
+        length(path)
+    return lengths
+
+
+def run(defs, path):
+    '''Compose a single component in a worker, then exit the worker.'''
+
+    from assembly import compose
+    try:
+        compose(defs, path)
+        wait_for_archives()
+        flush_last_used()
+    except KeyboardInterrupt:
+        os._exit(1)
+    except:
+        import traceback
+        traceback.print_exc()
+        log(path, 'ERROR: uncaught exception in worker', config.get('fork'))
+        os._exit(1)
+    os._exit(0)
+
+
+def schedule(defs, target):
+    '''Build everything needed for target, using up to 'instances' workers.
+
+    Artifacts which kbas has are downloaded by up to 'max-downloads' more
+    workers at the same time. With one instance the builds are done here,
+    between starting downloads.
+
+    '''
+    from assembly import compose
+    waiting = graph(defs, target)
+    lengths = critical_paths(defs, waiting)
+    running = {}
+    in_process = config.get('instances', 1) == 1
+    slots = {'build': range(config.get('instances', 1), 0, -1),
+             'download': ['d%s' % n for n in
+                          range(config.get('max-downloads', 4), 0, -1)]}
+    log('SCHEDULER', 'Components to build/download:', len(waiting))
+    if waiting:
+        log('SCHEDULER', 'Estimated critical path (seconds):',
+            max(lengths.values()))
+
+    def done(path):
+        for deps in waiting.values():
+            deps.discard(path)
+
+    def reap(pid, status):
+        if pid not in running:
+            archive_done(pid, status)  # or eg app.cleanup()'s process
+            return
+        path, pool, slot = running.pop(pid)
+        slots[pool].append(slot)
+        if status != 0:
+            for pid in running:
+                os.kill(pid, signal.SIGTERM)
+            app.exit(path, 'ERROR: worker %s failed to build' % slot, path)
+        done(path)
+
+    while waiting or running:
+        ready = sorted((p for p in waiting if not waiting[p]),
+                       key=lambda p: (-lengths[p], p))
+        for path in ready:
+            pool = 'download' if defs.get(path).get('remote') else 'build'
+            if not slots[pool] or (pool == 'build' and in_process):
+                continue
+            del waiting[path]
+            slot = slots[pool].pop()
+            pid = os.fork()
+            if pid == 0:
+                config['fork'] = slot
+                run(defs, path)
+            running[pid] = (path, pool, slot)
+            if config.get('log-verbose'):
+                log(path, 'Dispatched to worker %s, critical path' % slot,
+                    lengths[path])
+
+        builds = [p for p in ready if p in waiting and in_process]
+        if builds:
+            del waiting[builds[0]]
+            compose(defs, builds[0])
+            done(builds[0])
+            while running:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+                if pid == 0:
+                    break
+                reap(pid, status)
+            continue
+
+        if not running:
+            app.exit('SCHEDULER', 'ERROR: no workers free to build or '
+                     'download', ' '.join(sorted(waiting)))
+        reap(*os.wait())
+
+
+def plan(defs, target):
+    '''Log what would be built for target, and how long it should take.'''
+
+    nodes = graph(defs, target)
+    lengths = critical_paths(defs, nodes)
+    history = get_history()
+    total = 0
+    for path in sorted(nodes, key=lambda p: (-lengths[p], p)):
+        component = defs.get(path)
+        if component.get('remote'):
+            log(component, 'Would download', component['cache'])
+            continue
+        duration = get_duration(defs, path, history)
+        total += duration
+        log(component, 'Would build %s, estimated seconds' %
+            component['cache'], duration)
+
+    downloads = len([p for p in nodes if defs.get(p).get('remote')])
+    log('PLAN', 'Components to build:', len(nodes) - downloads)
+    log('PLAN', 'Components to download:', downloads)
+    log('PLAN', 'Estimated critical path (seconds):',
+        max(lengths.values() or [0]))
+    log('PLAN', 'Estimated total build time (seconds):', total)
@@ -65,31 +65,29 @@ def install_stratum_artifacts(defs, component, stratum, artifacts):
         if chunk.get('build-mode', 'staging') == 'bootstrap':
             continue
 
-        metafile = os.path.join(get_cache(defs, chunk) + '.unpacked',
-                                'baserock', chunk['name'] + '.meta')
+        metafile = get_metafile(defs, chunk)
         try:
-            with open(metafile, "r") as f:
-                filelist = []
-                metadata = yaml.safe_load(f)
-                split_metadata = {'cache': metadata['cache'],
-                                  'ref': metadata['ref'],
-                                  'repo': metadata['repo'],
-                                  'products': []}
-                for element in metadata['products']:
-                    if element['artifact'] in components:
-                        filelist += element.get('files', [])
-                        split_metadata['products'].append(element)
-
-                if split_metadata['products'] != []:
-                    split_metafile = os.path.join(baserockpath,
-                                                  os.path.basename(metafile))
-                    with open(split_metafile, "w") as f:
-                        yaml.safe_dump(split_metadata, f,
-                                       default_flow_style=False)
-
-                    cachepath, cachedir = os.path.split(get_cache(defs, chunk))
-                    path = os.path.join(cachepath, cachedir + '.unpacked')
-                    utils.copy_file_list(path, component['sandbox'], filelist)
+            filelist = []
+            metadata = get_metadata(defs, chunk)
+            split_metadata = {'cache': metadata['cache'],
+                              'ref': metadata['ref'],
+                              'repo': metadata['repo'],
+                              'products': []}
+            for element in metadata['products']:
+                if element['artifact'] in components:
+                    filelist += element.get('files', [])
+                    split_metadata['products'].append(element)
+
+            if split_metadata['products'] != []:
+                split_metafile = os.path.join(baserockpath,
+                                              os.path.basename(metafile))
+                with open(split_metafile, "w") as f:
+                    yaml.safe_dump(split_metadata, f,
+                                   default_flow_style=False)
+
+                cachepath, cachedir = os.path.split(get_cache(defs, chunk))
+                path = os.path.join(cachepath, cachedir + '.unpacked')
+                utils.copy_file_list(path, component['sandbox'], filelist)
         except:
             app.log(stratum, 'WARNING: problem loading ', metafile)
 
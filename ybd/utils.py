@@ -15,20 +15,57 @@
 # =*= License: GPL-2 =*=
 
 import gzip
+import hashlib
 import tarfile
 import contextlib
+import ctypes
+import errno
+import fcntl
 import os
+import pwd
+import grp
 import shutil
 import stat
+import time
+import zlib
+from collections import deque
+from cStringIO import StringIO
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 from fs.osfs import OSFS
 from fs.multifs import MultiFS
 import calendar
 
 import app
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 # The magic number for timestamps: 2011-11-11 11:11:11
 default_magic_timestamp = calendar.timegm([2011, 11, 11, 11, 11, 11])
 
+# Artifact compression codecs: gzip level, and whether blocks are compressed
+# in parallel. All of them produce gzip files which tar can unpack.
+codecs = {'gzip': (9, False), 'parallel-gzip': (9, True), 'fast': (1, True)}
+
+# Ways to copy a file, fastest first. The ones which work for each destination
+# filesystem are remembered in copy_methods, keyed by st_dev.
+FICLONE = 0x40049409
+copy_method_names = ['reflink', 'copy_file_range', 'sendfile', 'userspace']
+copy_methods = {}
+libc = ctypes.CDLL(None, use_errno=True)
+libc_copy_file_range = getattr(libc, 'copy_file_range', None)
+libc_sendfile = getattr(libc, 'sendfile', None)
+if libc_copy_file_range:
+    libc_copy_file_range.restype = ctypes.c_ssize_t
+if libc_sendfile:
+    libc_sendfile.restype = ctypes.c_ssize_t
+
 
 def set_mtime_recursively(root, set_time=default_magic_timestamp):
     '''Set the mtime for every file in a directory tree to the same.
@@ -36,29 +73,27 @@ def set_mtime_recursively(root, set_time=default_magic_timestamp):
     The aim is to make builds more predictable.
 
     '''
-
-    for dirname, subdirs, basenames in os.walk(root.encode("utf-8"),
-                                               topdown=False):
-        for basename in basenames:
-            pathname = os.path.join(dirname, basename)
-
-            # Python's os.utime only ever modifies the timestamp
-            # of the target, it is not acceptable to set the timestamp
-            # of the target here, if we are staging the link target we
-            # will also set it's timestamp.
-            #
-            # We should however find a way to modify the actual link's
-            # timestamp, this outdated python bug report claims that
-            # it is impossible:
-            #
-            #   http://bugs.python.org/issue623782
-            #
-            # However, nowadays it is possible at least on gnuish systems
-            # with with the lutimes function.
-            if not os.path.islink(pathname):
-                os.utime(pathname, (set_time, set_time))
-
-        os.utime(dirname, (set_time, set_time))
+    root = root.encode("utf-8")
+
+    def set_mtime(path, entry):
+        # Python's os.utime only ever modifies the timestamp
+        # of the target, it is not acceptable to set the timestamp
+        # of the target here, if we are staging the link target we
+        # will also set it's timestamp.
+        #
+        # We should however find a way to modify the actual link's
+        # timestamp, this outdated python bug report claims that
+        # it is impossible:
+        #
+        #   http://bugs.python.org/issue623782
+        #
+        # However, nowadays it is possible at least on gnuish systems
+        # with with the lutimes function.
+        if not entry.is_symlink():
+            os.utime(os.path.join(root, path), (set_time, set_time))
+
+    walk_tree(root, set_mtime)
+    os.utime(root, (set_time, set_time))
 
 
 def copy_all_files(srcpath, destpath):
@@ -68,13 +103,80 @@ def copy_all_files(srcpath, destpath):
 
     '''
 
-    def _copyfun(inpath, outpath):
-        with open(inpath, "r") as infh:
-            with open(outpath, "w") as outfh:
-                shutil.copyfileobj(infh, outfh, 1024*1024*4)
-        shutil.copystat(inpath, outpath)
+    _process_tree(srcpath, destpath, copy_file)
+
+
+def copy_file(inpath, outpath):
+    '''Copy a file and its permissions and times, as fast as possible.
+
+    Depending on 'copy-method', this clones the file (on btrfs or xfs), or
+    has the kernel copy it without it passing through ybd, or falls back to
+    reading and writing it. In 'auto' mode each method is tried in turn until
+    one works, and the ones which don't are skipped for that filesystem after.
+
+    '''
+    with open(inpath, 'rb') as infh:
+        with open(outpath, 'wb') as outfh:
+            method = app.config.get('copy-method', 'auto')
+            if method != 'auto':
+                copiers[method](infh, outfh)
+            else:
+                dev = os.fstat(outfh.fileno()).st_dev
+                for method in copy_methods.get(dev, copy_method_names):
+                    try:
+                        copiers[method](infh, outfh)
+                        break
+                    except (IOError, OSError) as e:
+                        if method == 'userspace' or e.errno not in (
+                                errno.EXDEV, errno.EINVAL, errno.ENOSYS,
+                                errno.EOPNOTSUPP, errno.ENOTTY):
+                            raise
+                        copy_methods[dev] = [m for m in copy_methods.get(
+                            dev, copy_method_names) if m != method]
+                        infh.seek(0)
+                        outfh.seek(0)
+                        outfh.truncate()
+    shutil.copystat(inpath, outpath)
+
+
+def _reflink(infh, outfh):
+    fcntl.ioctl(outfh.fileno(), FICLONE, infh.fileno())
+
 
-    _process_tree(srcpath, destpath, _copyfun)
+def _kernel_copy(copy, infh, outfh):
+    if copy is None:
+        raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+    size = os.fstat(infh.fileno()).st_size
+    while size > 0:
+        copied = copy(infh.fileno(), outfh.fileno(), min(size, 1 << 30))
+        if copied < 0:
+            e = ctypes.get_errno()
+            if e == errno.EINTR:
+                continue
+            raise OSError(e, os.strerror(e))
+        if copied == 0:
+            break
+        size -= copied
+
+
+def _copy_file_range(infh, outfh):
+    _kernel_copy(libc_copy_file_range and (
+        lambda fd_in, fd_out, size: libc_copy_file_range(
+            fd_in, None, fd_out, None, size, 0)), infh, outfh)
+
+
+def _sendfile(infh, outfh):
+    _kernel_copy(libc_sendfile and (
+        lambda fd_in, fd_out, size: libc_sendfile(
+            fd_out, fd_in, None, size)), infh, outfh)
+
+
+def _userspace(infh, outfh):
+    shutil.copyfileobj(infh, outfh, 1024*1024*4)
+
+
+copiers = {'reflink': _reflink, 'copy_file_range': _copy_file_range,
+           'sendfile': _sendfile, 'userspace': _userspace}
 
 
 def hardlink_all_files(srcpath, destpath):
@@ -86,50 +188,133 @@ def hardlink_all_files(srcpath, destpath):
     _process_tree(srcpath, destpath, os.link)
 
 
-def _process_tree(srcpath, destpath, actionfunc):
-    file_stat = os.lstat(srcpath)
-    mode = file_stat.st_mode
-
-    if stat.S_ISDIR(mode):
-        # Ensure directory exists in destination, then recurse.
-        if not os.path.lexists(destpath):
-            os.makedirs(destpath)
-        dest_stat = os.stat(os.path.realpath(destpath))
-        if not stat.S_ISDIR(dest_stat.st_mode):
-            raise IOError('Destination not a directory. source has %s'
-                          ' destination has %s' % (srcpath, destpath))
-
-        for entry in os.listdir(srcpath):
-            _process_tree(os.path.join(srcpath, entry),
-                          os.path.join(destpath, entry),
-                          actionfunc)
-    elif stat.S_ISLNK(mode):
-        # Copy the symlink.
-        if os.path.lexists(destpath):
-            import re
-            path = re.search('/.*$', re.search('tmp[^/]+/.*$',
-                             destpath).group(0)).group(0)
-            app.config['new-overlaps'] += [path]
-            os.remove(destpath)
-        os.symlink(os.readlink(srcpath), destpath)
-
-    elif stat.S_ISREG(mode):
-        # Process the file.
-        if os.path.lexists(destpath):
-            os.remove(destpath)
-        actionfunc(srcpath, destpath)
-
-    elif stat.S_ISCHR(mode) or stat.S_ISBLK(mode):
-        # Block or character device. Put contents of st_dev in a mknod.
-        if os.path.lexists(destpath):
-            os.remove(destpath)
-        os.mknod(destpath, file_stat.st_mode, file_stat.st_rdev)
-        os.chmod(destpath, file_stat.st_mode)
-
-    else:
-        # Unsupported type.
-        raise IOError('Cannot extract %s into staging-area. Unsupported'
-                      ' type.' % srcpath)
+def _process_tree(srcroot, destroot, actionfunc):
+
+    def process(path, entry):
+        srcpath = os.path.join(srcroot, path) if path else srcroot
+        destpath = os.path.join(destroot, path) if path else destroot
+
+        if entry.is_dir(follow_symlinks=False):
+            # Ensure directory exists in destination, then recurse.
+            if not os.path.lexists(destpath):
+                os.makedirs(destpath)
+            dest_stat = os.stat(os.path.realpath(destpath))
+            if not stat.S_ISDIR(dest_stat.st_mode):
+                raise IOError('Destination not a directory. source has %s'
+                              ' destination has %s' % (srcpath, destpath))
+
+        elif entry.is_symlink():
+            # Copy the symlink.
+            if os.path.lexists(destpath):
+                import re
+                path = re.search('/.*$', re.search('tmp[^/]+/.*$',
+                                 destpath).group(0)).group(0)
+                app.config['new-overlaps'] += [path]
+                os.remove(destpath)
+            os.symlink(os.readlink(srcpath), destpath)
+
+        elif entry.is_file(follow_symlinks=False):
+            # Process the file.
+            if os.path.lexists(destpath):
+                os.remove(destpath)
+            actionfunc(srcpath, destpath)
+
+        else:
+            file_stat = entry.stat(follow_symlinks=False)
+            if not stat.S_ISCHR(file_stat.st_mode) and \
+                    not stat.S_ISBLK(file_stat.st_mode):
+                # Unsupported type.
+                raise IOError('Cannot extract %s into staging-area. '
+                              'Unsupported type.' % srcpath)
+
+            # Block or character device. Put contents of st_dev in a mknod.
+            if os.path.lexists(destpath):
+                os.remove(destpath)
+            os.mknod(destpath, file_stat.st_mode, file_stat.st_rdev)
+            os.chmod(destpath, file_stat.st_mode)
+
+    root = _Entry(os.path.dirname(srcroot), os.path.basename(srcroot))
+    process('', root)
+    if root.is_dir(follow_symlinks=False):
+        walk_tree(srcroot, process)
+
+
+@contextlib.contextmanager
+def thread_pool():
+    '''Yield a ThreadPool with a thread per cpu, or None if there's one cpu.
+
+    The threads are joined on the way out, so none are left to be copied by
+    a later os.fork().
+
+    '''
+    if cpu_count() == 1:
+        yield None
+        return
+    pool = ThreadPool(cpu_count())
+    try:
+        yield pool
+    finally:
+        pool.close()
+        pool.join()
+
+
+def walk_tree(root, visit):
+    '''Call visit(path, entry) for everything under root, on a thread pool.
+
+    path is relative to root, and entry is a scandir entry (or as good as
+    one), so visit can use the type and stat it already has. Directories
+    are visited as they are found, before anything in them; everything else
+    goes to the pool, since it's mostly waiting on syscalls. With one cpu
+    everything is visited in turn. Returns how many entries were visited.
+
+    '''
+    start = time.time()
+    pending = deque()
+    count = [0]
+
+    def visit_all(batch):
+        for path, entry in batch:
+            visit(path, entry)
+
+    def submit(batch):
+        if pool:
+            pending.append(pool.apply_async(visit_all, (batch,)))
+        else:
+            visit_all(batch)
+
+    def scan(path):
+        directory = os.path.join(root, path)
+        if scandir:
+            entries = scandir(directory)
+        else:
+            entries = [_Entry(directory, n) for n in os.listdir(directory)]
+        batch = []
+        for entry in entries:
+            count[0] += 1
+            if entry.is_dir(follow_symlinks=False):
+                visit(os.path.join(path, entry.name), entry)
+                scan(os.path.join(path, entry.name))
+                continue
+            # a task per file would cost more than the syscalls it saves
+            batch.append((os.path.join(path, entry.name), entry))
+            if len(batch) == 256:
+                submit(batch)
+                batch = []
+        if batch:
+            submit(batch)
+        while len(pending) > 4 * cpu_count():
+            pending.popleft().get()
+
+    with thread_pool() as pool:
+        scan('')
+        while pending:
+            pending.popleft().get()
+
+    if app.config.get('log-verbose') and count[0] > 0:
+        rate = count[0] / max(time.time() - start, 0.001)
+        app.log('WALK', 'Visited %s entries in %s, per second:' % (
+            count[0], root), int(rate))
+    return count[0]
 
 
 def copy_file_list(srcpath, destpath, filelist):
@@ -139,13 +324,7 @@ def copy_file_list(srcpath, destpath, filelist):
 
     '''
 
-    def _copyfun(inpath, outpath):
-        with open(inpath, "r") as infh:
-            with open(outpath, "w") as outfh:
-                shutil.copyfileobj(infh, outfh, 1024*1024*4)
-        shutil.copystat(inpath, outpath)
-
-    _process_list(srcpath, destpath, filelist, _copyfun)
+    _process_list(srcpath, destpath, filelist, copy_file)
 
 
 def hardlink_file_list(srcpath, destpath, filelist):
@@ -227,7 +406,72 @@ def _process_list(srcdir, destdir, filelist, actionfunc):
                           ' type.' % srcpath)
 
 
-def make_deterministic_gztar_archive(base_name, root_dir, time=1321009871.0):
+class ParallelGzipWriter(object):
+    '''A file object which gzips what it is given in parallel.
+
+    The data is split into fixed size blocks, each compressed as a separate
+    gzip member on a thread pool (zlib releases the GIL) and written out in
+    order. Concatenated members are still a valid gzip file, and the output
+    only depends on the data, the level and the timestamp.
+
+    '''
+
+    def __init__(self, fileobj, level, time, block_size=4 * 1024 * 1024):
+        self.fileobj = fileobj
+        self.level = level
+        self.time = time
+        self.block_size = block_size
+        self.threads = cpu_count()
+        self.pool = ThreadPool(self.threads) if self.threads > 1 else None
+        self.pending = deque()
+        self.blocks = 0
+        self.buffer = []
+        self.buffered = 0
+        self.offset = 0
+
+    def _compress(self, block):
+        output = StringIO()
+        with gzip.GzipFile(filename='', mode='wb', fileobj=output,
+                           compresslevel=self.level, mtime=self.time) as f:
+            f.write(block)
+        return output.getvalue()
+
+    def _submit(self, block):
+        self.blocks += 1
+        if not self.pool:
+            self.fileobj.write(self._compress(block))
+            return
+        self.pending.append(self.pool.apply_async(self._compress, (block,)))
+        while len(self.pending) > 2 * self.threads:
+            self.fileobj.write(self.pending.popleft().get())
+
+    def tell(self):
+        return self.offset
+
+    def write(self, data):
+        self.offset += len(data)
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.block_size:
+            data = ''.join(self.buffer)
+            end = len(data) - len(data) % self.block_size
+            for start in range(0, end, self.block_size):
+                self._submit(data[start:start + self.block_size])
+            self.buffer = [data[end:]]
+            self.buffered = len(data) - end
+
+    def close(self):
+        if self.buffered or not self.blocks:
+            self._submit(''.join(self.buffer))
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().get())
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+
+
+def make_deterministic_gztar_archive(base_name, root_dir, time=1321009871.0,
+                                     compression='gzip'):
     '''Make a gzipped tar archive of contents of 'root_dir'.
 
     This function takes extra steps to ensure the output is deterministic,
@@ -255,19 +499,199 @@ def make_deterministic_gztar_archive(base_name, root_dir, time=1321009871.0):
             if os.path.isdir(name) and not os.path.islink(name):
                 add_directory_to_tarfile(f_tar, name, arcname)
 
+    level, parallel = codecs[compression]
     with open(base_name + '.tar.gz', 'wb') as f:
+        f = Checksum(f)
+        if parallel:
+            f_gzip = ParallelGzipWriter(f, level, time)
+            with tarfile.TarFile(mode='w', fileobj=f_gzip) as f_tar:
+                add_directory_to_tarfile(f_tar, root_dir, '.')
+            f_gzip.close()
+            return f.hexdigest()
+
         gzip_context = gzip.GzipFile(
-            filename='', mode='wb', fileobj=f, mtime=time)
+            filename='', mode='wb', fileobj=f, mtime=time,
+            compresslevel=level)
         with gzip_context as f_gzip:
             with tarfile.TarFile(mode='w', fileobj=f_gzip) as f_tar:
                 add_directory_to_tarfile(f_tar, root_dir, '.')
+    return f.hexdigest()
+
+
+class Checksum(object):
+    '''A file object which writes to another, keeping the md5 of the data.
+
+    So an artifact's checksum can be had as it is written or downloaded,
+    rather than by reading the whole thing again afterwards.
+
+    '''
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.md5 = hashlib.md5()
+
+    def write(self, data):
+        self.md5.update(data)
+        self.fileobj.write(data)
+
+    def tell(self):
+        return self.fileobj.tell()
+
+    def hexdigest(self):
+        return self.md5.hexdigest()
+
+
+class GunzipStream(object):
+    '''A file object which reads another, gunzipping it if it is gzipped.
+
+    Unlike GzipFile it never seeks, so it can read a download as it arrives,
+    and it reads on through all the gzip members, as ParallelGzipWriter
+    makes them.
+
+    '''
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.zlib = None
+        data = fileobj.read(2)
+        if data == '\x1f\x8b':
+            self.zlib = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            data = self.zlib.decompress(data)
+        self.buffer = data
+        self.offset = 0
+
+    def _decompress(self, data):
+        if self.zlib is None:
+            return data
+        output = self.zlib.decompress(data)
+        while self.zlib.unused_data:
+            data = self.zlib.unused_data
+            self.zlib = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            output += self.zlib.decompress(data)
+        return output
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) - self.offset < size:
+            data = self.fileobj.read(1024 * 1024)
+            if not data:
+                break
+            self.buffer = self.buffer[self.offset:] + self._decompress(data)
+            self.offset = 0
+        if size < 0:
+            size = len(self.buffer) - self.offset
+        data = self.buffer[self.offset:self.offset + size]
+        self.offset += len(data)
+        return data
+
+
+def extract(source, destdir):
+    '''Extract a tar (or tar.gz) artifact into destdir as tar would as root.
+
+    source is a filename or a file object, eg a download which is still
+    arriving. Entries are streamed, and regular files are written on a thread
+    pool while we read on. Modes, owners, mtimes, symlinks, hardlinks and
+    device nodes are all kept, so the result is what _process_tree expects.
+
+    '''
+    if isinstance(source, basestring):
+        with open(source, 'rb') as f:
+            return extract(f, destdir)
+
+    with thread_pool() as pool:
+        return _extract(source, destdir, pool)
+
+
+def _extract(source, destdir, pool):
+    pending = deque()
+    directories = []
+    owners = {}
+
+    def wait(limit):
+        while len(pending) > limit:
+            pending.popleft().get()
+
+    def set_attributes(path, member):
+        if os.geteuid() == 0:
+            if (member.uname, member.gname) not in owners:
+                try:
+                    uid = pwd.getpwnam(member.uname).pw_uid
+                except KeyError:
+                    uid = member.uid
+                try:
+                    gid = grp.getgrnam(member.gname).gr_gid
+                except KeyError:
+                    gid = member.gid
+                owners[(member.uname, member.gname)] = (uid, gid)
+            os.lchown(path, *owners[(member.uname, member.gname)])
+        if not member.issym():
+            os.chmod(path, member.mode)
+            os.utime(path, (member.mtime, member.mtime))
+
+    def write(path, data, member):
+        with open(path, 'wb') as f:
+            f.write(data)
+        set_attributes(path, member)
+
+    stream = GunzipStream(source)
+    with tarfile.open(fileobj=stream, mode='r|') as tar:
+        for member in tar:
+            name = os.path.normpath(member.name).lstrip('/')
+            if name.startswith('..'):
+                raise IOError('Refusing to extract %s' % member.name)
+            path = os.path.normpath(os.path.join(destdir, name))
+
+            if member.isdir():
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+                directories.append((path, member))
+                continue
+
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            if os.path.lexists(path):
+                os.remove(path)
+
+            if member.isreg() and member.size < 1024 * 1024:
+                data = tar.extractfile(member).read()
+                if pool:
+                    pending.append(pool.apply_async(write,
+                                                    (path, data, member)))
+                    wait(4 * cpu_count())
+                else:
+                    write(path, data, member)
+            elif member.isreg():
+                with open(path, 'wb') as f:
+                    shutil.copyfileobj(tar.extractfile(member), f,
+                                       1024 * 1024 * 4)
+                set_attributes(path, member)
+            elif member.islnk():
+                wait(0)
+                target = os.path.normpath(member.linkname).lstrip('/')
+                os.link(os.path.join(destdir, target), path)
+            elif member.issym():
+                os.symlink(member.linkname, path)
+                set_attributes(path, member)
+            elif member.ischr() or member.isblk():
+                kind = stat.S_IFCHR if member.ischr() else stat.S_IFBLK
+                os.mknod(path, member.mode | kind,
+                         os.makedev(member.devmajor, member.devminor))
+                set_attributes(path, member)
+            elif member.isfifo():
+                os.mkfifo(path)
+                set_attributes(path, member)
+
+    wait(0)
+    for path, member in reversed(directories):
+        set_attributes(path, member)
+    while stream.read(1024 * 1024):
+        pass  # so a download is complete, even after the end of the tar
 
 
 def make_deterministic_tar_archive(base_name, root_dir):
-    '''Make a tar archive of contents of 'root_dir'.
+    '''Make a tar archive of contents of 'root_dir', and return its md5.
 
-    This function uses monkeypatching to make shutil.make_archive() create
-    a deterministic tarfile.
+    This function uses monkeypatching to make tarfile create a deterministic
+    tarfile, the same as shutil.make_archive() would with sorted listings.
 
     https://bugs.python.org/issue24465 will make this function redundant.
 
@@ -277,8 +701,12 @@ def make_deterministic_tar_archive(base_name, root_dir):
     def stable_listdir(path):
         return sorted(real_listdir(path))
 
-    with monkeypatch(os, 'listdir', stable_listdir):
-        shutil.make_archive(base_name, 'tar', root_dir)
+    with open(base_name + '.tar', 'wb') as f:
+        f = Checksum(f)
+        with monkeypatch(os, 'listdir', stable_listdir), app.chdir(root_dir):
+            with tarfile.open(mode='w|', fileobj=f) as f_tar:
+                f_tar.add(os.curdir)
+    return f.hexdigest()
 
 
 def _find_extensions(paths):
@@ -304,10 +732,78 @@ def find_extensions():
     return _find_extensions(paths)
 
 
-def sorted_ls(path):
-    def mtime(f):
-        return os.stat(os.path.join(path, f)).st_mtime
-    return list(sorted(os.listdir(path), key=mtime))
+class _Entry(object):
+    '''The parts of a scandir entry we need, for when scandir isn't there.'''
+
+    def __init__(self, directory, name):
+        self.name = name
+        self.path = os.path.join(directory, name)
+
+    def is_dir(self, follow_symlinks=True):
+        return stat.S_ISDIR(self.stat(follow_symlinks).st_mode)
+
+    def is_file(self, follow_symlinks=True):
+        return stat.S_ISREG(self.stat(follow_symlinks).st_mode)
+
+    def is_symlink(self):
+        return os.path.islink(self.path)
+
+    def stat(self, follow_symlinks=True):
+        if follow_symlinks:
+            return os.stat(self.path)
+        return os.lstat(self.path)
+
+
+def find_files(root, suffixes):
+    '''Return [path, [size, mtime, inode]] for files under root with suffixes.
+
+    Files are in the same order as os.walk would find them with sorted
+    names, and .git directories and links to directories are skipped.
+
+    '''
+    found = []
+
+    def scan(path):
+        directory = os.path.join(root, path)
+        if scandir:
+            entries = list(scandir(directory))
+        else:
+            entries = [_Entry(directory, n) for n in os.listdir(directory)]
+        entries.sort(key=lambda entry: entry.name)
+        subdirs = []
+        for entry in entries:
+            if entry.is_dir():
+                if entry.name != '.git' and not entry.is_symlink():
+                    subdirs.append(entry.name)
+            elif entry.name.endswith(suffixes):
+                info = entry.stat()
+                found.append([os.path.join(path, entry.name),
+                              [info.st_size, int(info.st_mtime * 1000000),
+                               info.st_ino]])
+        for subdir in subdirs:
+            scan(os.path.join(path, subdir))
+
+    scan('')
+    return found
+
+
+def disk_usage(path):
+    '''Return roughly how many bytes deleting path would free.
+
+    Hardlinked files are shared out between their links, so files which are
+    also in the .cas store (or in other artifacts) only count in part.
+
+    '''
+    def usage(filename):
+        st = os.lstat(filename)
+        if stat.S_ISDIR(st.st_mode):
+            return st.st_blocks * 512
+        return st.st_blocks * 512 / st.st_nlink
+
+    total = usage(path)
+    for dirname, subdirs, files in os.walk(path):
+        total += sum(usage(os.path.join(dirname, f)) for f in subdirs + files)
+    return total
 
 
 @contextlib.contextmanager